@@ -1,4 +1,4 @@
-import { Controller, Post, Body, Res } from '@nestjs/common';
+import { Controller, Get, Post, Body, Res } from '@nestjs/common';
 import { Response } from 'express';
 import { AiService } from './ai.service';
 
@@ -6,24 +6,43 @@ import { AiService } from './ai.service';
 export class AiController {
   constructor(private readonly aiService: AiService) {}
 
+  @Get('metrics')
+  async metrics(@Res() res: Response) {
+    res.setHeader('Content-Type', 'text/plain; version=0.0.4');
+    res.send(await this.aiService.getMetrics());
+  }
+
   @Post('chat')
   async chat(
-    @Body() body: { message: string }, 
+    @Body() body: { message: string; conversationId?: string }, 
     @Res() res: Response
   ) {
     res.setHeader('Content-Type', 'text/event-stream');
     res.setHeader('Cache-Control', 'no-cache');
     res.setHeader('Connection', 'keep-alive');
 
+    // Client đóng kết nối trước khi stream xong thì hủy request ở RAG server
+    const abort = new AbortController();
+    res.on('close', () => {
+      if (!res.writableEnded) {
+        abort.abort();
+      }
+    });
+
     try {
       console.log('Receiving chat request:', body.message);
       
       await this.aiService.generateStreamResponse(
         body.message, 
         (chunk) => {
+          if (abort.signal.aborted) {
+            return;
+          }
           console.log('Sending chunk:', chunk);
           res.write(`data: ${JSON.stringify(chunk)}\n\n`);
-        }
+        },
+        body.conversationId,
+        abort.signal,
       );
       
       console.log('Stream completed');
@@ -1,14 +1,29 @@
-import { Injectable, OnModuleInit } from '@nestjs/common';
+import { Injectable, OnModuleDestroy, OnModuleInit } from '@nestjs/common';
 import { ConfigService } from '@nestjs/config';
-import { spawn } from 'child_process';
+import { ChildProcessWithoutNullStreams, execFile, spawn } from 'child_process';
+import { randomUUID } from 'crypto';
 import * as path from 'path';
+import * as readline from 'readline';
+
+interface PendingRequest {
+  onEvent: (event: any) => void;
+  resolve: () => void;
+  reject: (error: Error) => void;
+}
 
 @Injectable()
-export class AiService implements OnModuleInit {
+export class AiService implements OnModuleInit, OnModuleDestroy {
   private readonly pythonPath: string;
   private readonly scriptPath: string;
-  private conversationHistory: Array<{role: string, content: string}> = [];
-  private readonly MAX_HISTORY = 10;
+  // Hội thoại mặc định khi client không gửi conversationId, lịch sử được lưu ở RAG server
+  private readonly defaultConversationId = randomUUID();
+  private readonly RESTART_DELAY_MS = 2000;
+  private readonly HEALTH_TIMEOUT_MS = 10000;
+
+  // Process Python thường trú, load model và vector DB một lần duy nhất
+  private ragProcess: ChildProcessWithoutNullStreams | null = null;
+  private pendingRequests = new Map<string, PendingRequest>();
+  private shuttingDown = false;
 
   constructor(private configService: ConfigService) {
     this.pythonPath = this.configService.get<string>('PYTHON_PATH').replace(/\\/g, '/');
@@ -17,125 +32,202 @@ export class AiService implements OnModuleInit {
 
   async onModuleInit() {
     try {
-      const pythonProcess = spawn(this.pythonPath, ['--version']);
-      pythonProcess.on('error', (err) => {
-        console.error('Lỗi khởi tạo Python:', err);
-        throw err;
-      });
+      await this.checkHealth();
+      this.startRagServer();
     } catch (error) {
       console.error('Không thể khởi tạo Python environment:', error);
       throw error;
     }
   }
 
-  async generateResponse(userInput: string): Promise<string> {
+  onModuleDestroy() {
+    this.shuttingDown = true;
+    this.ragProcess?.kill();
+  }
+
+  // Kiểm tra nhanh Python, Ollama và vector DB (không load model)
+  private checkHealth(): Promise<void> {
     return new Promise((resolve, reject) => {
-      const pythonProcess = spawn(this.pythonPath, [this.scriptPath, userInput]);
-      
-      let result = '';
-      let error = '';
+      execFile(
+        this.pythonPath,
+        [this.scriptPath, '--health'],
+        { timeout: this.HEALTH_TIMEOUT_MS },
+        (error, stdout, stderr) => {
+          let health: any = null;
+          try {
+            health = JSON.parse(stdout);
+          } catch (e) {
+            // Không chạy được script (thiếu Python hoặc lỗi import)
+            console.error('RAG health check error:', stderr || error);
+            reject(error || e);
+            return;
+          }
 
-      pythonProcess.stdout.on('data', (data) => {
-        result += data.toString();
-      });
+          console.log(`RAG health: ${health.status} (import ${health.import_ms}ms)`);
+          for (const warning of health.warnings || []) {
+            console.warn('RAG health:', warning);
+          }
+          // Ollama chưa sẵn sàng không chặn việc khởi động, request sẽ báo lỗi riêng
+          resolve();
+        },
+      );
+    });
+  }
 
-      pythonProcess.stderr.on('data', (data) => {
-        error += data.toString();
-      });
+  private startRagServer() {
+    const ragProcess = spawn(this.pythonPath, [this.scriptPath, '--server'], {
+      stdio: ['pipe', 'pipe', 'pipe'],
+    });
+    this.ragProcess = ragProcess;
 
-      pythonProcess.on('close', (code) => {
-        if (code !== 0) {
-          console.error('Python script error:', error);
-          reject(new Error('Lỗi khi chạy Python script'));
-          return;
-        }
+    readline.createInterface({ input: ragProcess.stdout }).on('line', (line) => {
+      if (!line.trim()) {
+        return;
+      }
+      try {
+        this.dispatchEvent(JSON.parse(line));
+      } catch (e) {
+        console.error('Error parsing chunk:', e, 'Raw data:', line);
+      }
+    });
 
-        try {
-          const response = JSON.parse(result);
-          if (response.error) {
-            reject(new Error(response.error));
-            return;
-          }
-          
-          console.log('Context used:', response.context);
-          resolve(response.response);
-        } catch (e) {
-          console.error('Error parsing Python response:', e);
-          reject(new Error('Lỗi khi xử lý kết quả từ Python'));
-        }
-      });
+    // Python dừng đúng lúc đang ghi request/cancel (EPIPE): lỗi của stream không được làm sập Nest,
+    // các request đang chờ không còn nhận được kết quả
+    ragProcess.stdin.on('error', (err) => {
+      console.error('Không ghi được tới RAG server:', err);
+      this.rejectPending(new Error(`Không gửi được request tới RAG server: ${err.message}`));
+    });
+
+    ragProcess.stderr.on('data', (data) => {
+      console.error('Python stderr:', data.toString());
     });
+
+    ragProcess.on('error', (err) => {
+      console.error('Lỗi khởi tạo Python:', err);
+    });
+
+    ragProcess.on('exit', (code) => {
+      console.error('RAG server exited with code:', code);
+      this.ragProcess = null;
+
+      // Các request đang chờ sẽ không bao giờ nhận được kết quả
+      this.rejectPending(new Error(`RAG server đã dừng (code ${code})`));
+
+      if (!this.shuttingDown) {
+        setTimeout(() => this.startRagServer(), this.RESTART_DELAY_MS);
+      }
+    });
+  }
+
+  private rejectPending(error: Error) {
+    const pendingRequests = Array.from(this.pendingRequests.values());
+    this.pendingRequests.clear();
+    for (const pending of pendingRequests) {
+      pending.reject(error);
+    }
   }
 
-  async generateStreamResponse(userInput: string, onChunk: (chunk: any) => void): Promise<void> {
+  private dispatchEvent(event: any) {
+    if (event.type === 'ready') {
+      console.log('RAG server ready');
+      return;
+    }
+
+    const pending = this.pendingRequests.get(event.id);
+    if (!pending) {
+      return;
+    }
+
+    if (event.type === 'done') {
+      this.pendingRequests.delete(event.id);
+      pending.resolve();
+      return;
+    }
+
+    const { id, ...chunk } = event;
+    pending.onEvent(chunk);
+  }
+
+  private sendRequest(
+    request: Record<string, any>,
+    onEvent: (event: any) => void,
+    signal?: AbortSignal,
+  ): Promise<void> {
     return new Promise((resolve, reject) => {
-      try {
-        console.log('Starting Python process with input:', userInput);
-        
-        const pythonProcess = spawn(
-          this.pythonPath, 
-          [
-            this.scriptPath, 
-            userInput, 
-            '--stream', 
-            'true',
-            '--history', 
-            JSON.stringify(this.conversationHistory)
-          ],
-          { stdio: ['pipe', 'pipe', 'pipe'] }
-        );
-      
-        let responseContent = '';
-        let error = '';
-
-        pythonProcess.stdout.on('data', (data) => {
-          const lines = data.toString().split('\n');
-          for (const line of lines) {
-            if (line.trim()) {
-              try {
-                const chunk = JSON.parse(line);
-                if (chunk.type === 'token') {
-                  responseContent += chunk.content;
-                }
-                onChunk(chunk);
-              } catch (e) {
-                console.error('Error parsing chunk:', e, 'Raw data:', line);
-              }
-            }
-          }
-        });
-
-        pythonProcess.stderr.on('data', (data) => {
-          error += data.toString();
-          console.error('Python stderr:', data.toString());
-        });
-
-        pythonProcess.on('error', (err) => {
-          console.error('Python process error:', err);
-          reject(new Error(`Lỗi khi chạy Python process: ${err.message}`));
-        });
-
-        pythonProcess.on('close', (code) => {
-          console.log('Python process closed with code:', code);
-          if (code !== 0) {
-            console.error('Python script error:', error);
-            reject(new Error(`Lỗi khi chạy Python script (code ${code}): ${error}`));
-            return;
-          }
+      if (!this.ragProcess) {
+        reject(new Error('RAG server chưa sẵn sàng'));
+        return;
+      }
+
+      const id = randomUUID();
+      this.pendingRequests.set(id, { onEvent, resolve, reject });
+      this.ragProcess.stdin.write(JSON.stringify({ id, ...request }) + '\n', (err) => {
+        if (err && this.pendingRequests.delete(id)) {
+          reject(new Error(`Không gửi được request tới RAG server: ${err.message}`));
+        }
+      });
 
-          this.conversationHistory.push({ role: 'user', content: userInput });
-          this.conversationHistory.push({ role: 'assistant', content: responseContent });
-          
-          if (this.conversationHistory.length > this.MAX_HISTORY) {
-            this.conversationHistory = this.conversationHistory.slice(-this.MAX_HISTORY);
+      // Client ngắt kết nối: báo RAG server hủy request để dừng sinh câu trả lời ngay,
+      // request vẫn kết thúc bằng event done như bình thường
+      signal?.addEventListener(
+        'abort',
+        () => {
+          if (this.pendingRequests.has(id)) {
+            this.ragProcess?.stdin.write(JSON.stringify({ op: 'cancel', id }) + '\n');
           }
-          
-          resolve();
-        });
-      } catch (error) {
-        console.error('Error in generateStreamResponse:', error);
-        reject(error);
+        },
+        { once: true },
+      );
+    });
+  }
+
+  async getMetrics(): Promise<string> {
+    let metrics = '';
+
+    await this.sendRequest({ op: 'metrics' }, (event) => {
+      if (event.type === 'metrics') {
+        metrics = event.content;
       }
     });
+
+    return metrics;
+  }
+
+  async generateResponse(userInput: string): Promise<string> {
+    let result: any = null;
+
+    await this.sendRequest(
+      { query: userInput, stream: false },
+      (event) => {
+        result = event;
+      },
+    );
+
+    if (!result || result.type === 'error') {
+      throw new Error(result?.content || 'Lỗi khi xử lý kết quả từ Python');
+    }
+
+    console.log('Context used:', result.context);
+    return result.response;
+  }
+
+  async generateStreamResponse(
+    userInput: string,
+    onChunk: (chunk: any) => void,
+    conversationId: string = this.defaultConversationId,
+    signal?: AbortSignal,
+  ): Promise<void> {
+    console.log('Sending request to RAG server:', userInput);
+
+    // Chỉ gửi tin nhắn mới, RAG server tự giữ lịch sử theo conversation_id
+    await this.sendRequest(
+      {
+        query: userInput,
+        stream: true,
+        conversation_id: conversationId,
+      },
+      onChunk,
+      signal,
+    );
   }
-} 
\ No newline at end of file
+}
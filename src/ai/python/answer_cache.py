@@ -0,0 +1,97 @@
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+class AnswerCache:
+    # Cache câu trả lời theo (câu hỏi đã chuẩn hóa, route), có TTL và giới hạn
+    # số entry (LRU). Nếu không khớp chính xác thì so khớp theo độ tương đồng
+    # embedding của câu hỏi trong cùng route.
+    def __init__(self, max_size=256, ttl=3600, similarity_threshold=0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @property
+    def semantic_enabled(self):
+        return self.enabled and self.similarity_threshold < 1
+
+    @staticmethod
+    def normalize(query):
+        query = re.sub(r"\s+", " ", query.lower()).strip()
+        return query.rstrip("?!.… ")
+
+    @staticmethod
+    def _unit(vector):
+        norm = math.sqrt(sum(x * x for x in vector))
+        return [x / norm for x in vector] if norm else list(vector)
+
+    def _expired(self, entry, now):
+        return self.ttl > 0 and now - entry["created_at"] > self.ttl
+
+    def get(self, query, route, embedding=None):
+        if not self.enabled:
+            return None
+
+        key = (self.normalize(query), route)
+        now = time.time()
+        with self.lock:
+            # Dọn các entry hết hạn trước khi tìm
+            for expired_key in [k for k, entry in self.entries.items() if self._expired(entry, now)]:
+                del self.entries[expired_key]
+
+            entry = self.entries.get(key)
+            if entry is None and embedding is not None and self.semantic_enabled:
+                query_vector = self._unit(embedding)
+                best_score = self.similarity_threshold
+                for candidate_key, candidate in self.entries.items():
+                    if candidate_key[1] != route or candidate["embedding"] is None:
+                        continue
+                    score = sum(a * b for a, b in zip(query_vector, candidate["embedding"]))
+                    if score >= best_score:
+                        best_score = score
+                        key, entry = candidate_key, candidate
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, query, route, answer, context, sources, embedding=None):
+        if not self.enabled or not answer:
+            return
+
+        key = (self.normalize(query), route)
+        with self.lock:
+            self.entries[key] = {
+                "answer": answer,
+                "context": context,
+                "sources": set(sources),
+                "embedding": self._unit(embedding) if embedding is not None else None,
+                "created_at": time.time(),
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, routes=(), sources=()):
+        # Xóa các câu trả lời của route có index thay đổi hoặc đã dùng file nguồn vừa đổi
+        routes, sources = set(routes), set(sources)
+        with self.lock:
+            stale = [
+                key for key, entry in self.entries.items()
+                if key[1] in routes or entry["sources"] & sources
+            ]
+            for key in stale:
+                del self.entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import rag_service as rag
+from tracing import metrics
+
+# Bộ câu hỏi cố định (tiếng Việt và tiếng Anh) kèm route và file nguồn mong đợi
+# để tính tỉ lệ retrieval trúng theo từng route. Có thể thay bằng --queries file.json
+BENCHMARK_QUERIES = [
+    {"query": "Giá gói VIP bao nhiêu một tháng?", "route": "membership", "source": "membership.txt"},
+    {"query": "Có những gói tập nào?", "route": "membership", "source": "membership.txt"},
+    {"query": "How much is the premium membership?", "route": "membership", "source": "membership.txt"},
+    {"query": "Lịch học yoga vào những ngày nào?", "route": "classes", "source": "classes.txt"},
+    {"query": "What classes are available in the evening?", "route": "classes", "source": "classes.txt"},
+    {"query": "Có bài tập nào cho người mới bắt đầu không?", "route": "practice", "source": "practice.txt"},
+    {"query": "Show me some chest exercises", "route": "practice", "source": "practice.txt"},
+    {"query": "Phòng gym có những huấn luyện viên nào?", "route": "instructors", "source": "instructors.txt"},
+    {"query": "Who are the personal trainers?", "route": "instructors", "source": "instructors.txt"},
+    {"query": "Cách đăng ký tài khoản như thế nào?", "route": "guide", "source": "guide.txt"},
+    {"query": "How to book a class?", "route": "guide", "source": "guide.txt"},
+    {"query": "Phòng gym mở cửa lúc mấy giờ?", "route": "gym_info", "source": "gym_info.txt"},
+    {"query": "Where is the gym located?", "route": "gym_info", "source": "gym_info.txt"},
+]
+
+STUB_ANSWER = "Đây là câu trả lời mẫu của benchmark, không gọi tới Ollama thật."
+
+class StubResponse:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class StubStream:
+    # Giống AsyncStream của openai: duyệt bằng async for, close() để dừng giữa chừng
+    def __init__(self, words, token_delay):
+        self.words = words
+        self.token_delay = token_delay
+        self.closed = False
+
+    async def __aiter__(self):
+        for i, word in enumerate(self.words):
+            if self.closed:
+                return
+            await asyncio.sleep(self.token_delay)
+            finish_reason = "stop" if i == len(self.words) - 1 else None
+            yield StubResponse(choices=[StubResponse(delta=StubResponse(content=word + " "), finish_reason=finish_reason)])
+
+    async def close(self):
+        self.closed = True
+
+class StubCompletions:
+    # Thay gemma2 bằng câu trả lời cố định, có độ trễ giả lập cho mỗi token.
+    # Router LLM (gemma2:9b) trả về đúng route đã gán nhãn để không ảnh hưởng retrieval
+    def __init__(self, labels, token_delay):
+        self.labels = labels
+        self.token_delay = token_delay
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        if model == "gemma2:9b":
+            match = re.search(r'Câu hỏi hiện tại: "(.*)"', messages[-1]["content"])
+            route = self.labels.get(match.group(1) if match else "", "none")
+            return StubResponse(choices=[StubResponse(message=StubResponse(content=route))])
+
+        if not stream:
+            await asyncio.sleep(self.token_delay * len(STUB_ANSWER.split()))
+            return StubResponse(choices=[StubResponse(message=StubResponse(content=STUB_ANSWER), finish_reason="stop")])
+
+        return StubStream(STUB_ANSWER.split(" "), self.token_delay)
+
+class StubClient:
+    def __init__(self, labels, token_delay):
+        self.chat = StubResponse(completions=StubCompletions(labels, token_delay))
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(values):
+    # Thời gian tính bằng ms
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(max(values), 3),
+    }
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Windows không có module resource
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 1024 / 1024, 1)
+        except Exception:
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    return round(peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024, 1)
+
+def elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+def bench_index():
+    # Thời gian load (hoặc build nếu chưa có) vector DB, tính cả load model embedding
+    rag.clear_vectorstore_cache()
+    started = time.perf_counter()
+    vectorstore = rag.load_documents()
+    if vectorstore is None:
+        raise Exception("Không load được vector DB")
+    return vectorstore, round(elapsed_ms(started), 3)
+
+def bench_retrieval(vectorstore, queries, rounds):
+    embeddings = rag.get_embeddings()
+    router = rag.get_route_classifier()
+    timings = {"embed_query": [], "routing": [], "retrieval": [], "retrieval_unfiltered": []}
+    per_route = {}
+
+    for _ in range(rounds):
+        for item in queries:
+            started = time.perf_counter()
+            query_embedding = embeddings.embed_query(item["query"])
+            timings["embed_query"].append(elapsed_ms(started))
+
+            predicted = None
+            if router is not None:
+                started = time.perf_counter()
+                predicted, _, _ = router.classify(query_embedding)
+                timings["routing"].append(elapsed_ms(started))
+
+            started = time.perf_counter()
+            docs = rag.search_documents(vectorstore, query_embedding, item["route"])
+            timings["retrieval"].append(elapsed_ms(started))
+
+            started = time.perf_counter()
+            unfiltered = rag.search_documents(vectorstore, query_embedding)
+            timings["retrieval_unfiltered"].append(elapsed_ms(started))
+
+            def hit(results):
+                return any(os.path.basename(str(doc.metadata.get("source", ""))) == item["source"] for doc in results)
+
+            stats = per_route.setdefault(item["route"], {
+                "queries": 0, "hits": 0, "unfiltered_hits": 0, "router_correct": 0, "router_fallback": 0
+            })
+            stats["queries"] += 1
+            stats["hits"] += hit(docs)
+            stats["unfiltered_hits"] += hit(unfiltered)
+            stats["router_correct"] += predicted == item["route"]
+            stats["router_fallback"] += router is not None and predicted is None
+
+    for stats in per_route.values():
+        stats["hit_rate"] = round(stats["hits"] / stats["queries"], 3)
+        stats["unfiltered_hit_rate"] = round(stats["unfiltered_hits"] / stats["queries"], 3)
+        stats["router_accuracy"] = round(stats["router_correct"] / stats["queries"], 3)
+
+    total = sum(stats["queries"] for stats in per_route.values())
+    return {
+        "latency_ms": {stage: summarize(values) for stage, values in timings.items()},
+        "hit_rate": round(sum(stats["hits"] for stats in per_route.values()) / max(total, 1), 3),
+        "per_route": per_route,
+    }
+
+async def bench_end_to_end(queries, concurrency, requests):
+    # Chạy requests câu hỏi qua toàn bộ pipeline async, tối đa concurrency request cùng lúc
+    slots = asyncio.Semaphore(concurrency)
+    latencies, ttfts, errors = [], [], 0
+
+    async def run(i):
+        nonlocal errors
+        item = queries[i % len(queries)]
+        async with slots:
+            started = time.perf_counter()
+            first_token = None
+
+            def emit(event):
+                nonlocal first_token, errors
+                if event.get("type") == "token" and first_token is None:
+                    first_token = elapsed_ms(started)
+                elif event.get("type") == "error":
+                    errors += 1
+
+            await rag.aget_response(item["query"], [], stream=True, emit=emit, request_id=f"bench-{i}")
+            latencies.append(elapsed_ms(started))
+            if first_token is not None:
+                ttfts.append(first_token)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[run(i) for i in range(requests)])
+    wall = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(requests / wall, 3),
+        "latency_ms": summarize(latencies),
+        "ttft_ms": summarize(ttfts),
+    }
+
+def stage_means():
+    # Thời gian trung bình từng bước lấy từ trace của các request end-to-end
+    with metrics.lock:
+        return {
+            stage: round(histogram["sum"] / histogram["count"], 3)
+            for stage, histogram in sorted(metrics.histograms.items())
+            if histogram["count"]
+        }
+
+def compare(result, baseline, max_regression, min_delta_ms=1.0):
+    # So sánh p95 với lần chạy trước, trả về danh sách các chỉ số chậm đi quá max_regression (%)
+    # và quá min_delta_ms (bỏ qua dao động của các bước chỉ mất vài micro giây)
+    regressions = []
+
+    def check(name, current, previous):
+        if current is None or not previous:
+            return
+        change = (current - previous) / previous * 100
+        print(f"{name}: {previous:.2f} -> {current:.2f} ms ({change:+.1f}%)", file=sys.stderr)
+        if change > max_regression and current - previous > min_delta_ms:
+            regressions.append(name)
+
+    for stage, summary in result["retrieval"]["latency_ms"].items():
+        check(f"{stage}.p95", summary.get("p95"), baseline.get("retrieval", {}).get("latency_ms", {}).get(stage, {}).get("p95"))
+    previous_runs = {run["concurrency"]: run for run in baseline.get("end_to_end", [])}
+    for run in result["end_to_end"]:
+        previous = previous_runs.get(run["concurrency"])
+        if previous:
+            check(f"end_to_end[c={run['concurrency']}].p95", run["latency_ms"].get("p95"), previous["latency_ms"].get("p95"))
+
+    previous_hit_rate = baseline.get("retrieval", {}).get("hit_rate")
+    if previous_hit_rate is not None and result["retrieval"]["hit_rate"] < previous_hit_rate:
+        print(f"hit_rate: {previous_hit_rate} -> {result['retrieval']['hit_rate']}", file=sys.stderr)
+        regressions.append("hit_rate")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval và end-to-end latency của RAG service")
+    parser.add_argument("--queries", help="File JSON [{query, route, source}] thay cho bộ câu hỏi mặc định")
+    parser.add_argument("--documents", help="Thư mục tài liệu (mặc định: documents của project), luôn build index mới")
+    parser.add_argument("--fresh-index", action="store_true",
+                        help="Build vector DB và embedding cache mới trong thư mục tạm để đo thời gian build")
+    parser.add_argument("--rounds", type=int, default=3, help="Số lượt chạy bộ câu hỏi khi đo retrieval")
+    parser.add_argument("--concurrency", default="1,4,16", help="Các mức request đồng thời, vd: 1,4,16")
+    parser.add_argument("--requests", type=int, default=64, help="Số request end-to-end cho mỗi mức concurrency")
+    parser.add_argument("--token-delay-ms", type=float, default=20, help="Độ trễ giả lập cho mỗi token của LLM")
+    parser.add_argument("--answer-cache", action="store_true", help="Giữ answer cache khi chạy end-to-end")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file (mặc định: stdout)")
+    parser.add_argument("--baseline", help="File kết quả lần trước để so sánh")
+    parser.add_argument("--max-regression", type=float, default=20, help="Phần trăm p95 chậm đi tối đa so với baseline")
+    parser.add_argument("--min-delta-ms", type=float, default=1, help="Bỏ qua các thay đổi p95 nhỏ hơn số ms này")
+    args = parser.parse_args()
+
+    queries = BENCHMARK_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = json.load(f)
+
+    if args.documents:
+        rag.DOCUMENTS_DIR = os.path.abspath(args.documents)
+        rag.CRAWLED_DATA_DIR = os.path.join(rag.DOCUMENTS_DIR, "crawled_data")
+        # Index hiện có là của bộ tài liệu khác, đo trên đó sẽ sai
+        args.fresh_index = True
+
+    temp_dir = None
+    if args.fresh_index:
+        temp_dir = tempfile.mkdtemp(prefix="rag-bench-")
+        rag.DB_PATH = os.path.join(temp_dir, "vector_db")
+        rag.EMBEDDING_CACHE_PATH = os.path.join(temp_dir, "embedding_cache.sqlite3")
+
+    if not args.answer_cache:
+        rag.answer_cache.max_size = 0
+    # Không crawl trong lúc benchmark, route thiếu dữ liệu sẽ fallback như bình thường
+    rag.crawl_website = lambda route: False
+    stub = StubClient({item["query"]: item["route"] for item in queries}, args.token_delay_ms / 1000)
+    rag.get_ai_client = lambda: stub
+
+    try:
+        vectorstore, index_ms = bench_index()
+        result = {
+            "timestamp": time.time(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "config": {
+                "embedding_model": rag.EMBEDDING_MODEL,
+                "vector_backend": rag.VECTOR_BACKEND,
+                "fresh_index": args.fresh_index,
+                "retrieval_k": rag.RETRIEVAL_K,
+                "retrieval_mode": rag.RETRIEVAL_MODE,
+                "embed_batch_size": rag.EMBED_BATCH_SIZE,
+                "router_threshold": rag.ROUTER_THRESHOLD,
+                "token_delay_ms": args.token_delay_ms,
+                "answer_cache": args.answer_cache,
+            },
+            "queries": len(queries),
+            "index_build_ms": index_ms,
+            "retrieval": bench_retrieval(vectorstore, queries, args.rounds),
+            "end_to_end": [],
+        }
+
+        for concurrency in [int(value) for value in args.concurrency.split(",") if value.strip()]:
+            result["end_to_end"].append(asyncio.run(bench_end_to_end(queries, concurrency, args.requests)))
+
+        result["stages_mean_ms"] = stage_means()
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        if temp_dir:
+            rag.clear_vectorstore_cache()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.max_regression, args.min_delta_ms)
+        if regressions:
+            print(f"Chậm hơn baseline: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import fnmatch
+import json
+import os
+import re
+
+# Cách chia theo file nguồn, luật đầu tiên có pattern khớp (theo đường dẫn dạng a/b/c.txt) được dùng.
+# parent là đoạn có thể đưa vào prompt, child là đoạn nhỏ được embed để tìm kiếm.
+# mode "records": mỗi record là một parent (dữ liệu crawl: gói tập, lớp học... mỗi record
+# bắt đầu bằng một dòng không phải gạch đầu dòng); "sections": chia theo đoạn văn
+DEFAULT_RULES = [
+    {"pattern": "*/crawled_data/*", "mode": "records", "parent_chars": 1500, "child_chars": 300, "child_overlap": 60},
+    {"pattern": "*", "mode": "sections", "parent_chars": 1500, "child_chars": 400, "child_overlap": 80},
+]
+RECORD_START = re.compile(r"\n(?=[^\s\-+])")
+
+class HierarchicalSplitter:
+    # Chia tài liệu thành parent và các child nằm trong parent.
+    # Trả về (parent, vị trí child trong parent, child) để lúc ghép context
+    # có thể mở rộng child ra parent khi còn budget.
+    def __init__(self, rules=None):
+        self.rules = list(rules or [])
+
+    @classmethod
+    def from_file(cls, path):
+        # File JSON là danh sách luật giống DEFAULT_RULES, được xét trước các luật mặc định;
+        # khóa nào thiếu thì lấy theo luật mặc định khớp với file
+        if not path or not os.path.isfile(path):
+            return cls()
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def rule_for(self, source):
+        path = os.path.normpath(source).replace(os.sep, "/")
+        default = next(rule for rule in DEFAULT_RULES if fnmatch.fnmatch(path, rule["pattern"]))
+        for rule in self.rules:
+            if fnmatch.fnmatch(path, rule["pattern"]):
+                return {**default, **rule}
+        return default
+
+    @staticmethod
+    def _splitter(size, overlap):
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        return RecursiveCharacterTextSplitter(
+            chunk_size=size,
+            chunk_overlap=overlap,
+            length_function=len,
+            separators=["\n\n\n", "\n\n", "\n", ".", " ", ""],
+            is_separator_regex=False
+        )
+
+    def parents(self, text, rule):
+        splitter = self._splitter(rule["parent_chars"], 0)
+        if rule["mode"] != "records":
+            return [parent for parent in splitter.split_text(text) if parent.strip()]
+        parents = []
+        for record in RECORD_START.split(text):
+            record = record.strip()
+            if not record:
+                continue
+            # Record quá dài thì chia tiếp như văn bản thường
+            parents.extend([record] if len(record) <= rule["parent_chars"] else splitter.split_text(record))
+        return parents
+
+    def children(self, parent, rule):
+        # (vị trí trong parent, child); -1 nếu không tìm lại được vị trí
+        if len(parent) <= rule["child_chars"]:
+            return [(0, parent)]
+        children = []
+        cursor = 0
+        for child in self._splitter(rule["child_chars"], rule["child_overlap"]).split_text(parent):
+            start = parent.find(child, cursor)
+            if start == -1:
+                start = parent.find(child)
+            children.append((start, child))
+            if start != -1:
+                cursor = start + 1
+        return children
+
+    def split(self, text, source):
+        rule = self.rule_for(source)
+        for parent in self.parents(text, rule):
+            for start, child in self.children(parent, rule):
+                yield parent, start, child
@@ -0,0 +1,177 @@
+import math
+import re
+
+class ContextBuilder:
+    # Ghép các chunk tìm được thành context cho prompt trong giới hạn token:
+    # bỏ chunk trùng, nối các chunk liền kề của cùng file (bỏ phần overlap),
+    # ưu tiên chunk có điểm cao hơn. Chunk có parent (metadata parent/start) được gộp theo
+    # parent, rồi mở rộng ra parent nếu còn budget. Lịch sử hội thoại được cắt theo giới hạn riêng.
+    # Số token được ước lượng theo số ký tự vì không có tokenizer của gemma2 ở đây.
+    def __init__(self, max_tokens=1500, history_tokens=400, chars_per_token=3.0, min_overlap=20, max_overlap=1000):
+        self.max_tokens = max_tokens
+        self.history_tokens = history_tokens
+        self.chars_per_token = chars_per_token
+        self.min_overlap = min_overlap
+        self.max_overlap = max_overlap
+
+    def count_tokens(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def _max_chars(self, tokens):
+        return max(0, int(tokens * self.chars_per_token))
+
+    def overlap(self, first, second):
+        # Độ dài đoạn cuối của first trùng với đoạn đầu của second
+        longest = min(len(first), len(second), self.max_overlap)
+        for size in range(longest, self.min_overlap - 1, -1):
+            if first.endswith(second[:size]):
+                return size
+        return 0
+
+    def truncate(self, text, tokens, suffix="…"):
+        # Cắt text về tối đa tokens, ưu tiên cắt ở cuối câu hoặc cuối dòng
+        max_chars = self._max_chars(tokens)
+        if len(text) <= max_chars:
+            return text
+        cut = text[:max(0, max_chars - len(suffix))]
+        boundary = max(cut.rfind("\n"), *(cut.rfind(mark) for mark in (". ", "! ", "? ")))
+        if boundary > len(cut) // 2:
+            cut = cut[:boundary + 1]
+        return cut.rstrip() + suffix
+
+    @staticmethod
+    def _clean(text):
+        return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+    def expand(self, parent, start, end, tokens):
+        # Đoạn quanh parent[start:end] dài nhất trong tokens, mở đều hai phía và cắt ở đầu/cuối dòng
+        max_chars = self._max_chars(tokens)
+        if len(parent) <= max_chars:
+            return parent
+        extra = max(0, max_chars - (end - start))
+        low = max(0, start - extra // 2)
+        high = min(len(parent), end + extra - (start - low))
+        if high == len(parent):
+            # Chạm cuối parent thì dồn phần còn lại sang phía trước
+            low = max(0, high - max_chars)
+        if low > 0:
+            line = parent.find("\n", low, start)
+            low = line + 1 if line != -1 else low
+        if high < len(parent):
+            line = parent.rfind("\n", end, high)
+            high = line if line != -1 else high
+        return parent[low:high]
+
+    @staticmethod
+    def _rank(docs):
+        # Chunk có distance (khoảng cách tới câu hỏi) nhỏ hơn đứng trước,
+        # chunk không có distance giữ nguyên thứ tự tìm kiếm
+        order = {id(doc): i for i, doc in enumerate(docs)}
+        return sorted(docs, key=lambda doc: (doc.metadata.get("distance", math.inf), order[id(doc)]))
+
+    def _merge(self, passage, text):
+        # Trả về text mới của passage nếu text nối được với passage, None nếu không liên quan
+        current = passage["text"]
+        if text in current:
+            return current
+        if current in text:
+            return text
+        size = self.overlap(current, text)
+        if size:
+            return current + text[size:]
+        size = self.overlap(text, current)
+        if size:
+            return text + current[size:]
+        return None
+
+    def build(self, docs, max_tokens=None):
+        # Trả về (context, số đoạn đã dùng)
+        budget = self.max_tokens if max_tokens is None else max_tokens
+        passages = []
+        used = 0
+        seen = set()
+
+        for doc in self._rank(docs):
+            text = self._clean(doc.page_content)
+            if not text or text in seen:
+                continue
+            seen.add(text)
+            source = doc.metadata.get("source")
+            parent = doc.metadata.get("parent")
+            start = doc.metadata.get("start", -1)
+            span = (start, start + len(doc.page_content)) if parent and start >= 0 else None
+
+            merged = False
+            for passage in passages:
+                if passage["source"] != source:
+                    continue
+                if parent and passage["parent"] == parent:
+                    # Chunk khác của cùng parent: lấy đoạn parent bao cả hai chunk
+                    if span is None or passage["span"] is None:
+                        merged = True
+                        break
+                    new_span = (min(passage["span"][0], span[0]), max(passage["span"][1], span[1]))
+                    new_text = self._clean(parent[new_span[0]:new_span[1]])
+                elif not parent and not passage["parent"]:
+                    new_span = None
+                    new_text = self._merge(passage, text)
+                    if new_text is None:
+                        continue
+                else:
+                    continue
+                added = self.count_tokens(new_text) - self.count_tokens(passage["text"])
+                if used + added <= budget:
+                    passage["text"] = new_text
+                    passage["span"] = new_span
+                    used += added
+                merged = True
+                break
+            if merged:
+                continue
+
+            tokens = self.count_tokens(text)
+            if used + tokens > budget:
+                if passages:
+                    # Chunk sau có thể ngắn hơn và vẫn vừa
+                    continue
+                # Chunk tốt nhất dài hơn cả budget thì cắt bớt
+                text = self.truncate(text, budget)
+                tokens = self.count_tokens(text)
+                span = None
+            passages.append({"source": source, "text": text, "parent": parent, "span": span})
+            used += tokens
+
+        # Còn budget thì mở rộng từng đoạn ra parent của nó, đoạn điểm cao trước
+        for passage in passages:
+            remaining = budget - used
+            if remaining <= 0:
+                break
+            if not passage["parent"] or passage["span"] is None:
+                continue
+            current = self.count_tokens(passage["text"])
+            expanded = self._clean(self.expand(passage["parent"], *passage["span"], current + remaining))
+            added = self.count_tokens(expanded) - current
+            if added > 0 and used + added <= budget:
+                passage["text"] = expanded
+                used += added
+
+        return "\n\n".join(passage["text"] for passage in passages), len(passages)
+
+    def fit_history(self, history, max_messages=3, max_tokens=None):
+        # Giữ các tin nhắn gần nhất trong budget; tin nhắn quá dài (thường là câu
+        # trả lời trước) bị cắt bớt thay vì bỏ hẳn
+        budget = self.history_tokens if max_tokens is None else max_tokens
+        fitted = []
+        used = 0
+        for message in reversed((history or [])[-max_messages:]):
+            remaining = budget - used
+            if remaining <= 0:
+                break
+            content = message["content"]
+            if self.count_tokens(content) > remaining:
+                if remaining < 16:
+                    break
+                content = self.truncate(content, remaining)
+            fitted.append({"role": message["role"], "content": content})
+            used += self.count_tokens(content)
+        return list(reversed(fitted))
@@ -0,0 +1,131 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Từ khóa để đoán chủ đề từ câu trả lời của trợ lý, xét theo thứ tự
+TOPIC_KEYWORDS = [
+    ("membership", ("gói tập", "plan")),
+    ("classes", ("lớp", "lịch học")),
+    ("instructors", ("huấn luyện viên", "pt")),
+    ("practice", ("bài tập", "hướng dẫn tập")),
+]
+# Câu hỏi có các từ này thì đã rõ chủ đề, không cần xem lịch sử
+QUERY_TOPIC_KEYWORDS = ("lớp", "pt", "gói", "bài tập", "huấn luyện")
+
+def detect_topic(text):
+    lowered = text.lower()
+    for topic, keywords in TOPIC_KEYWORDS:
+        if any(keyword in lowered for keyword in keywords):
+            return topic
+    return None
+
+class Conversation:
+    # Trạng thái của một hội thoại: vài tin nhắn gần nhất (kèm chủ đề đã phân tích
+    # một lần khi thêm vào), tóm tắt ngắn các tin nhắn cũ hơn và embedding câu hỏi đã tính
+    def __init__(self, window=3, summary_lines=6, summary_chars=160, max_embeddings=16):
+        self.messages = deque()
+        self.window = window
+        self.summary = deque(maxlen=summary_lines)
+        self.summary_chars = summary_chars
+        self.embeddings = OrderedDict()
+        self.max_embeddings = max_embeddings
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_history(cls, history, **kwargs):
+        # Dùng cho CLI (--history): dựng hội thoại tạm từ danh sách tin nhắn
+        conversation = cls(**kwargs)
+        for message in history or []:
+            conversation.add(message["role"], message["content"])
+        return conversation
+
+    def _compact(self, message):
+        # Câu đầu tiên của tin nhắn, cắt còn tối đa summary_chars ký tự
+        text = re.split(r"(?<=[.!?])\s", message["content"].strip(), maxsplit=1)[0]
+        if len(text) > self.summary_chars:
+            text = text[:self.summary_chars - 1].rstrip() + "…"
+        return f"{message['role']}: {text}"
+
+    def add(self, role, content):
+        with self.lock:
+            self.messages.append({
+                "role": role,
+                "content": content,
+                "topic": detect_topic(content) if role == "assistant" else None
+            })
+            while len(self.messages) > self.window:
+                self.summary.append(self._compact(self.messages.popleft()))
+            self.updated_at = time.time()
+
+    def add_turn(self, query, answer):
+        self.add("user", query)
+        self.add("assistant", answer)
+
+    def history(self):
+        with self.lock:
+            return [{"role": message["role"], "content": message["content"]} for message in self.messages]
+
+    def summary_text(self):
+        with self.lock:
+            return "\n".join(self.summary)
+
+    def topic_context(self, query):
+        # Trả về (chủ đề hiện tại, context hội thoại cho router LLM).
+        # Tin nhắn mới nhất của trợ lý được ưu tiên; nếu câu hỏi chưa rõ chủ đề
+        # thì xét thêm các tin nhắn gần nhất
+        with self.lock:
+            messages = list(self.messages)
+        if not messages:
+            return None, ""
+        latest_topic = messages[-1]["topic"]
+        current_topic = None
+        conversation_context = ""
+        if not any(keyword in query.lower() for keyword in QUERY_TOPIC_KEYWORDS):
+            for message in messages[-3:]:
+                current_topic = message["topic"] or current_topic
+                conversation_context += f"{message['role']}: {message['content']}\n"
+        return latest_topic or current_topic, conversation_context
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.strip().lower().encode("utf-8")).hexdigest()
+
+    def get_embedding(self, text):
+        with self.lock:
+            return self.embeddings.get(self._key(text))
+
+    def put_embedding(self, text, embedding):
+        with self.lock:
+            self.embeddings[self._key(text)] = embedding
+            while len(self.embeddings) > self.max_embeddings:
+                self.embeddings.popitem(last=False)
+
+class ConversationStore:
+    # Các hội thoại đang mở, theo conversation id (LRU, hết hạn sau ttl giây không dùng)
+    def __init__(self, max_size=1000, ttl=6 * 3600, **conversation_kwargs):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.conversation_kwargs = conversation_kwargs
+        self.conversations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, conversation_id):
+        now = time.time()
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is not None and self.ttl > 0 and now - conversation.updated_at > self.ttl:
+                conversation = None
+            if conversation is None:
+                conversation = Conversation(**self.conversation_kwargs)
+                self.conversations[conversation_id] = conversation
+            self.conversations.move_to_end(conversation_id)
+            while len(self.conversations) > self.max_size:
+                self.conversations.popitem(last=False)
+            return conversation
+
+    def reset(self, conversation_id):
+        with self.lock:
+            return self.conversations.pop(conversation_id, None) is not None
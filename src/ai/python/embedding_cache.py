@@ -0,0 +1,95 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from tracing import get_logger
+
+logger = get_logger('rag.embedding_cache')
+
+class CachedEmbeddings:
+    # Bọc model embedding, lưu vector của từng chunk vào SQLite theo
+    # (tên model, hash nội dung) để lần build/crawl sau chỉ embed text mới.
+    # Dùng được ở mọi chỗ cần embedding_function của langchain.
+    SQL_BATCH = 500
+
+    def __init__(self, embeddings, model_name, path):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _lookup(self, hashes):
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), self.SQL_BATCH):
+                batch = hashes[start:start + self.SQL_BATCH]
+                rows = self.connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [self.model_name, *batch]
+                )
+                for text_hash, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[text_hash] = vector.tolist()
+        return found
+
+    def _store(self, items):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                [(self.model_name, text_hash, array('f', vector).tobytes()) for text_hash, vector in items]
+            )
+            self.connection.commit()
+
+    def embed_documents(self, texts):
+        hashes = [self.text_hash(text) for text in texts]
+        vectors = self._lookup(list(set(hashes)))
+
+        # Chỉ embed các text chưa có trong cache (mỗi text một lần)
+        missing = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), computed))
+            try:
+                self._store(new_items)
+            except sqlite3.Error as e:
+                logger.error(f"Không ghi được embedding cache: {str(e)}")
+            vectors.update(new_items)
+
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text):
+        # Câu hỏi của người dùng ít lặp lại, không cần lưu xuống disk
+        return self.embeddings.embed_query(text)
+
+    def reopen(self):
+        # Kết nối SQLite không dùng chung được qua fork: process con mở kết nối riêng
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
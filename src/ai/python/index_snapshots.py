@@ -0,0 +1,83 @@
+import os
+import shutil
+import time
+from tracing import get_logger
+
+logger = get_logger('rag.snapshots')
+
+class SnapshotStore:
+    # Các phiên bản index nằm trong root/snapshots/<version>, file root/CURRENT ghi
+    # phiên bản đang phục vụ. Snapshot đã publish không bị sửa nữa: lần index sau
+    # build vào thư mục mới (thường là bản sao của snapshot hiện tại), kiểm tra xong
+    # mới đổi CURRENT bằng os.replace, nên request đang đọc bản cũ không bị ảnh hưởng.
+    POINTER_FILE = "CURRENT"
+    SNAPSHOTS_DIR = "snapshots"
+    STALE_BUILD_SECONDS = 3600
+
+    def __init__(self, root, retention=3):
+        self.root = root
+        self.retention = max(1, retention)
+
+    def path(self, version):
+        return os.path.join(self.root, self.SNAPSHOTS_DIR, version)
+
+    def current_version(self):
+        try:
+            with open(os.path.join(self.root, self.POINTER_FILE), encoding='utf-8') as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return version if version and os.path.isdir(self.path(version)) else None
+
+    def versions(self):
+        # Cũ tới mới (tên phiên bản sắp xếp được theo thời gian tạo)
+        directory = os.path.join(self.root, self.SNAPSHOTS_DIR)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
+
+    def create(self, base=None):
+        # Tạo thư mục cho phiên bản mới, sao chép từ base nếu có để chỉ phải index phần thay đổi
+        version = time.strftime("%Y%m%dT%H%M%S") + f"-{time.time_ns() % 1_000_000_000:09d}-{os.getpid()}"
+        path = self.path(version)
+        if base is not None:
+            shutil.copytree(self.path(base), path)
+        else:
+            os.makedirs(path)
+        return version
+
+    def publish(self, version):
+        pointer = os.path.join(self.root, self.POINTER_FILE)
+        with open(pointer + ".tmp", 'w', encoding='utf-8') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer + ".tmp", pointer)
+        logger.info(f"Index: chuyển sang snapshot {version}")
+
+    def discard(self, version):
+        shutil.rmtree(self.path(version), ignore_errors=True)
+
+    def cleanup(self, release=None):
+        # Giữ retention phiên bản mới nhất tới bản đang phục vụ (luôn giữ bản này), vì worker
+        # có thể vẫn đọc bản cũ tới hết request. Bản mới hơn CURRENT là bản đang build
+        # (có thể của process khác), chỉ xóa khi đã bỏ dở quá STALE_BUILD_SECONDS.
+        # release(version) được gọi trước khi xóa để đóng vector store còn mở snapshot đó.
+        # Trên Windows file đang mở không xóa được, lần dọn sau sẽ thử lại
+        current = self.current_version()
+        if current is None:
+            return
+        versions = self.versions()
+        published = [version for version in versions if version <= current]
+        remove = published[:-self.retention]
+        for version in versions:
+            if version > current and time.time() - os.path.getmtime(self.path(version)) > self.STALE_BUILD_SECONDS:
+                remove.append(version)
+        for version in remove:
+            if release is not None:
+                release(version)
+            try:
+                shutil.rmtree(self.path(version))
+                logger.info(f"Đã xóa snapshot cũ {version}")
+            except OSError as e:
+                logger.error(f"Không xóa được snapshot {version}, sẽ thử lại lần sau: {str(e)}")
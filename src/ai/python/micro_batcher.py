@@ -0,0 +1,63 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from tracing import get_logger, metrics
+
+logger = get_logger('rag.batcher')
+
+class MicroBatcher:
+    # Gom các lời gọi tới trong vòng max_wait giây (tối đa max_batch lời gọi)
+    # thành một lần gọi fn(items), rồi trả từng kết quả về đúng lời gọi.
+    # submit() chặn thread gọi tới; trong event loop dùng asyncio.wrap_future(enqueue(item)).
+    def __init__(self, fn, max_batch=16, max_wait=0.003, name="batcher"):
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.name = name
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def submit(self, item):
+        return self.enqueue(item).result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            # Bỏ các lời gọi đã bị hủy (vd: request bị hủy khi đang chờ wrap_future);
+            # future còn lại chuyển sang running nên không bị hủy giữa chừng nữa
+            batch = [(item, future) for item, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            metrics.increment("rag_batches_total", {"batcher": self.name})
+            metrics.increment("rag_batch_items_total", {"batcher": self.name}, amount=len(batch))
+            try:
+                results = list(self.fn([item for item, _ in batch]))
+                if len(results) != len(batch):
+                    raise ValueError(f"trả về {len(results)} kết quả cho {len(batch)} item")
+            except Exception as e:
+                logger.error(f"{self.name}: lỗi khi xử lý batch {len(batch)} item: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                try:
+                    future.set_result(result)
+                except InvalidStateError:
+                    pass
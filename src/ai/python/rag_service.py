@@ -1,207 +1,649 @@
-from openai import OpenAI
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+import time
+_import_started = time.perf_counter()
 import os
 import sys
 import json
 import argparse
-from web_crawler import crawl_website
+import asyncio
+import weakref
+import threading
+import hashlib
+import re
+import gc
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from answer_cache import AnswerCache
+from route_classifier import RouteClassifier, parse_route
+from refresh_scheduler import RefreshScheduler
+from embedding_cache import CachedEmbeddings
+from context_builder import ContextBuilder
+from chunking import HierarchicalSplitter
+from index_snapshots import SnapshotStore
+from micro_batcher import MicroBatcher
+from conversation_store import Conversation, ConversationStore
+from worker_pool import RemoteScheduler, WorkerPool
+from tracing import Trace, get_logger, metrics
+# openai/httpx, langchain, torch (HuggingFaceEmbeddings), Chroma, numpy và web_crawler
+# (Selenium, BeautifulSoup) chỉ được import trong hàm cần tới chúng
+
+sys.stdout.reconfigure(encoding='utf-8')
+sys.stderr.reconfigure(encoding='utf-8')
+
+load_dotenv()
+
+logger = get_logger('rag')
+
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+# Đường dẫn cho vector database: mỗi lần index là một snapshot trong DB_PATH/snapshots,
+# DB_PATH/CURRENT chỉ tới snapshot đang dùng; giữ lại RAG_INDEX_RETENTION snapshot gần nhất
+DB_PATH = os.getenv('RAG_INDEX_PATH', "C:/FlexFit/vector_db")
+INDEX_RETENTION = int(os.getenv('RAG_INDEX_RETENTION', '3'))
+# chroma (SQLite của Chroma) hoặc numpy (ma trận trong process, hợp với corpus nhỏ)
+VECTOR_BACKEND = os.getenv('RAG_VECTOR_BACKEND', 'chroma').lower()
+# Embedding của các chunk đã tính, nằm ngoài vector DB để vẫn dùng được khi build lại
+EMBEDDING_CACHE_PATH = os.getenv(
+    'RAG_EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(DB_PATH), 'embedding_cache.sqlite3')
+)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+DOCUMENTS_DIR = os.path.join(BASE_DIR, 'documents')
+CRAWLED_DATA_DIR = os.path.join(DOCUMENTS_DIR, 'crawled_data')
+# Tăng khi đổi metadata của chunk để lần sync sau index lại toàn bộ
+INDEX_SCHEMA_VERSION = 4
+# Luật chia parent/child theo file nguồn (JSON, xem chunking.DEFAULT_RULES), bỏ trống = luật mặc định
+CHUNKING_FILE = os.getenv('RAG_CHUNKING_FILE', '')
+
+# Chế độ server: số request xử lý đồng thời trên event loop, và số thread
+# cho các bước blocking (embedding, tìm kiếm vector, crawl)
+SERVER_CONCURRENCY = int(os.getenv('RAG_SERVER_CONCURRENCY', '32'))
+SERVER_WORKERS = int(os.getenv('RAG_SERVER_WORKERS', '4'))
+# Chế độ pre-fork (chỉ trên hệ có fork): số process worker dùng chung model của process cha;
+# index chỉ dùng chung được với RAG_VECTOR_BACKEND=numpy, Chroma phải mở lại trong từng worker
+# (1 = một process như trước), số request chờ tối đa khi mọi worker đều bận,
+# và số thread torch của mỗi worker (các worker đã chia nhau các core)
+SERVER_PROCESSES = int(os.getenv('RAG_SERVER_PROCESSES', '1'))
+SERVER_QUEUE = int(os.getenv('RAG_SERVER_QUEUE', '64'))
+WORKER_TORCH_THREADS = int(os.getenv('RAG_WORKER_TORCH_THREADS', '1'))
+
+# Ollama (API tương thích OpenAI): một client async dùng chung, giữ sẵn kết nối
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434/v1')
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', '16'))
+OLLAMA_TIMEOUT = float(os.getenv('OLLAMA_TIMEOUT', '120'))
+
+# Độ dài tối đa câu trả lời (token) theo route, route khác dùng RAG_MAX_TOKENS;
+# ghi đè bằng RAG_ROUTE_MAX_TOKENS="practice=800,none=100"
+GENERATION_MAX_TOKENS = int(os.getenv('RAG_MAX_TOKENS', '400'))
+ROUTE_MAX_TOKENS = {
+    "gym_info": 200,
+    "membership": 350,
+    "classes": 350,
+    "instructors": 300,
+    "practice": 600,
+    "guide": 500,
+    "none": 150,
+    **{
+        route.strip(): int(limit)
+        for route, limit in (item.split('=', 1) for item in os.getenv('RAG_ROUTE_MAX_TOKENS', '').split(',') if '=' in item)
+    }
+}
+# Dừng sinh khi model bắt đầu tự viết tiếp lượt hỏi mới (phân cách bằng |, \n là xuống dòng)
+GENERATION_STOP = [
+    stop.replace('\\n', '\n')
+    for stop in os.getenv('RAG_STOP_SEQUENCES', '<end_of_turn>|\\nCâu hỏi:|\\nNgười dùng:|\\nuser:').split('|')
+    if stop
+]
+
+# Gom token thành frame trước khi gửi: tối đa số ký tự hoặc thời gian chờ (ms), 0 = gửi từng token
+STREAM_FRAME_CHARS = int(os.getenv('RAG_STREAM_FRAME_CHARS', '48'))
+STREAM_FRAME_MS = float(os.getenv('RAG_STREAM_FRAME_MS', '40'))
+
+# Cache câu trả lời cho các câu hỏi lặp lại (RAG_ANSWER_CACHE_SIZE=0 để tắt)
+answer_cache = AnswerCache(
+    max_size=int(os.getenv('RAG_ANSWER_CACHE_SIZE', '256')),
+    ttl=float(os.getenv('RAG_ANSWER_CACHE_TTL', '3600')),
+    similarity_threshold=float(os.getenv('RAG_ANSWER_CACHE_SIMILARITY', '0.95'))
+)
+
+# Route có trang trên frontend để crawl, và thứ tự route tìm thay khi route hiện tại không có dữ liệu
+CRAWLABLE_ROUTES = ["classes", "practice", "instructors", "membership"]
+FALLBACK_ROUTES = ["classes", "practice", "instructors", "membership", "guide", "gym_info"]
+
+# Số tài liệu lấy khi retrieval; RAG_RETRIEVAL_MODE=mmr để giảm các chunk trùng ý
+RETRIEVAL_K = int(os.getenv('RAG_RETRIEVAL_K', '5'))
+RETRIEVAL_MODE = os.getenv('RAG_RETRIEVAL_MODE', 'similarity').lower()
+RETRIEVAL_FETCH_K = int(os.getenv('RAG_RETRIEVAL_FETCH_K', '20'))
+# Khi phải hỏi router gemma2:9b: tìm kiếm song song luôn (không lọc route, lấy dư
+# RAG_SPECULATIVE_K kết quả để lọc lại khi có route) và tìm sẵn trong route router cục bộ đoán
+SPECULATIVE_RETRIEVAL = os.getenv('RAG_SPECULATIVE_RETRIEVAL', 'true').lower() == 'true'
+SPECULATIVE_K = int(os.getenv('RAG_SPECULATIVE_K', '20'))
+
+# Giới hạn token (ước lượng) của context tài liệu và lịch sử hội thoại trong prompt gemma2:2b
+context_builder = ContextBuilder(
+    max_tokens=int(os.getenv('RAG_CONTEXT_TOKENS', '1500')),
+    history_tokens=int(os.getenv('RAG_HISTORY_TOKENS', '400')),
+    chars_per_token=float(os.getenv('RAG_CHARS_PER_TOKEN', '3'))
+)
+
+# Hội thoại lưu phía server theo conversation id: vài tin nhắn gần nhất, chủ đề và tóm tắt
+SESSION_WINDOW = int(os.getenv('RAG_SESSION_WINDOW', '3'))
+conversations = ConversationStore(
+    max_size=int(os.getenv('RAG_SESSION_MAX', '1000')),
+    ttl=float(os.getenv('RAG_SESSION_TTL', str(6 * 3600))),
+    window=SESSION_WINDOW
+)
+
+# Các route được crawl nền khi chạy server, và chu kỳ crawl lại (giây, 0 = chỉ crawl lúc khởi động)
+CRAWL_ROUTES = [route.strip() for route in os.getenv('RAG_CRAWL_ROUTES', ','.join(CRAWLABLE_ROUTES)).split(',') if route.strip()]
+REFRESH_INTERVAL = float(os.getenv('RAG_REFRESH_INTERVAL', '3600'))
+
+# Số file được đọc và split song song, và số chunk embed trong một batch khi index
+INGEST_WORKERS = int(os.getenv('RAG_INGEST_WORKERS', '4'))
+EMBED_BATCH_SIZE = int(os.getenv('RAG_EMBED_BATCH_SIZE', '64'))
+
+# Ngưỡng tự tin của router cục bộ, dưới ngưỡng thì hỏi gemma2:9b
+# (RAG_ROUTER_THRESHOLD > 1 để luôn dùng LLM router)
+ROUTER_THRESHOLD = float(os.getenv('RAG_ROUTER_THRESHOLD', '0.45'))
+ROUTER_MIN_MARGIN = float(os.getenv('RAG_ROUTER_MIN_MARGIN', '0.05'))
+
+# Chế độ server: gom các câu hỏi đến gần nhau (trong RAG_BATCH_WINDOW_MS, tối đa
+# RAG_BATCH_MAX_SIZE câu) để embed và tìm kiếm một lần cho cả batch (0 = tắt)
+BATCH_WINDOW_MS = float(os.getenv('RAG_BATCH_WINDOW_MS', '3'))
+BATCH_MAX_SIZE = int(os.getenv('RAG_BATCH_MAX_SIZE', '16'))
+
+# Thời gian import module tối đa (ms) trước khi --health báo chậm
+IMPORT_BUDGET_MS = float(os.getenv('RAG_IMPORT_BUDGET_MS', '250'))
+HEALTH_TIMEOUT = float(os.getenv('RAG_HEALTH_TIMEOUT', '3'))
 
 # Biến global để lưu cache
 _vectorstore_cache = None
+_vectorstore_version = None
+# Vector store của các snapshot đã thay, đóng khi snapshot bị xóa (phiên bản -> vector store)
+_retired_vectorstores = OrderedDict()
+_embeddings_cache = None
+_route_classifier_cache = None
+# Chỉ có khi chạy server; khi đó request chat không bao giờ tự crawl
+_refresh_scheduler = None
+_ai_clients = weakref.WeakKeyDictionary()
+_embed_batcher = None
+_search_batcher = None
+# Lock để nhiều request đồng thời không load model/vector DB hai lần
+_vectorstore_lock = threading.RLock()
+# Mỗi lúc chỉ build một snapshot; request vẫn đọc snapshot hiện tại trong lúc build.
+# Thứ tự lock: luôn lấy _index_build_lock trước rồi mới tới _vectorstore_lock,
+# không bao giờ chờ _index_build_lock khi đang giữ _vectorstore_lock
+_index_build_lock = threading.Lock()
+_stdout_lock = threading.Lock()
 
-def init_ai():
-    client = OpenAI(
-        base_url="http://localhost:11434/v1",
-        api_key="ollama",
-    )
+def get_ai_client():
+    # Mỗi event loop một client, dùng lại connection pool cho mọi request
+    loop = asyncio.get_running_loop()
+    client = _ai_clients.get(loop)
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(
+            base_url=OLLAMA_BASE_URL,
+            api_key="ollama",
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_MAX_CONNECTIONS
+                ),
+                timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=5.0)
+            )
+        )
+        _ai_clients[loop] = client
     return client
 
+class TokenFrames:
+    # Gom các token liên tiếp thành một event, gửi khi đủ max_chars ký tự
+    # hoặc token đầu tiên trong frame đã chờ quá max_delay giây
+    def __init__(self, emit, max_chars=None, max_delay=None):
+        # Mặc định đọc cấu hình lúc tạo (không cố định lúc import)
+        self.emit = emit
+        self.max_chars = STREAM_FRAME_CHARS if max_chars is None else max_chars
+        self.max_delay = STREAM_FRAME_MS / 1000 if max_delay is None else max_delay
+        self.buffer = []
+        self.size = 0
+        self.timer = None
+
+    def add(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.max_chars or self.max_delay <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            content = "".join(self.buffer)
+            self.buffer, self.size = [], 0
+            self.emit({
+                "type": "token",
+                "content": content
+            })
+
+def emit_stdout(event):
+    # Ghi một event JSON ra stdout (mỗi event một dòng)
+    with _stdout_lock:
+        print(json.dumps(event))
+        sys.stdout.flush()
+
+def get_embeddings():
+    # Model embedding chỉ load một lần cho cả process
+    global _embeddings_cache
+    with _vectorstore_lock:
+        if _embeddings_cache is None:
+            # Import torch/transformers mất vài giây, chỉ làm khi thật sự cần embedding
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            embeddings = HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL,
+                encode_kwargs={'batch_size': EMBED_BATCH_SIZE}
+            )
+            try:
+                _embeddings_cache = CachedEmbeddings(embeddings, EMBEDDING_MODEL, EMBEDDING_CACHE_PATH)
+            except Exception as e:
+                logger.error(f"Không mở được embedding cache {EMBEDDING_CACHE_PATH}: {str(e)}")
+                _embeddings_cache = embeddings
+        return _embeddings_cache
+
+def embed_queries(queries):
+    # Một lần forward của model cho cả batch câu hỏi.
+    # Embedding câu hỏi không lưu vào disk cache (giống CachedEmbeddings.embed_query)
+    embeddings = get_embeddings()
+    if isinstance(embeddings, CachedEmbeddings):
+        embeddings = embeddings.embeddings
+    return embeddings.embed_documents(list(queries))
+
+def embed_query(query):
+    return get_embeddings().embed_query(query)
+
+async def aembed_query(query):
+    # Khi chạy server, câu hỏi được gom batch với các request đang chờ khác
+    if _embed_batcher is not None:
+        return await asyncio.wrap_future(_embed_batcher.enqueue(query))
+    return await asyncio.to_thread(embed_query, query)
+
+def get_route_classifier():
+    # Centroid của các câu hỏi mẫu chỉ tính một lần
+    global _route_classifier_cache
+    if ROUTER_THRESHOLD > 1:
+        return None
+    with _vectorstore_lock:
+        if _route_classifier_cache is None:
+            try:
+                _route_classifier_cache = RouteClassifier(
+                    get_embeddings(),
+                    threshold=ROUTER_THRESHOLD,
+                    min_margin=ROUTER_MIN_MARGIN
+                )
+            except Exception as e:
+                logger.error(f"Không thể khởi tạo router cục bộ: {str(e)}")
+                return None
+        return _route_classifier_cache
+
 def load_documents():
+    # Không cần lock khi snapshot đã mở vẫn là snapshot CURRENT
+    vectorstore = _vectorstore_cache
+    if vectorstore is not None and _vectorstore_version == index_snapshots().current_version():
+        return vectorstore
     try:
-        global _vectorstore_cache
+        vectorstore = _open_current_snapshot()
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc tài liệu: {str(e)}")
+        return None
+    if vectorstore is not None:
+        return vectorstore
+    # Chưa có snapshot nào: build bản đầu tiên (hoặc chờ lần build đang chạy xong)
+    with _index_build_lock:
+        return _load_documents()
+
+def index_snapshots():
+    return SnapshotStore(DB_PATH, INDEX_RETENTION)
+
+def get_text_splitter():
+    # Chunk nhỏ (child) để embed, kèm đoạn lớn chứa nó (parent) để đưa vào prompt
+    return HierarchicalSplitter.from_file(CHUNKING_FILE)
+
+def list_source_files():
+    # Chỉ lấy file .txt trực tiếp trong documents và trong crawled_data
+    files = []
+    for directory in (DOCUMENTS_DIR, CRAWLED_DATA_DIR):
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith('.txt') and os.path.isfile(path):
+                files.append(os.path.normpath(path))
+    return files
+
+def crawled_file_path(route):
+    return os.path.normpath(os.path.join(CRAWLED_DATA_DIR, f"{route}.txt"))
+
+def route_from_source(source):
+    # Giữ luật cũ: file thuộc route nếu tên file chứa tên route
+    # (membership.txt, membership_plans.txt -> membership); không khớp route nào thì lấy tên file
+    name = os.path.splitext(os.path.basename(source))[0].lower()
+    return next((route for route in FALLBACK_ROUTES if route in name), name)
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def load_file_chunks(source):
+    # Split một file thành các child chunk, id chunk = hash(phiên bản schema + file nguồn
+    # + hash parent + hash nội dung) nên chunk không đổi sẽ giữ nguyên id và embedding cũ.
+    # Metadata giữ parent và vị trí của chunk trong parent để mở rộng context khi còn budget
+    from langchain.schema import Document
+    with open(source, encoding='utf-8') as f:
+        text = f.read()
+    splitter = get_text_splitter()
+    chunks = {}
+    parents = set()
+    for parent, start, child in splitter.split(text, source):
+        parent_id = content_hash(parent)
+        parents.add(parent)
+        chunk = Document(page_content=child, metadata={
+            'source': source,
+            'route': route_from_source(source),
+            'content_hash': content_hash(child),
+            'parent_id': parent_id,
+            'parent': parent,
+            'start': start
+        })
+        chunk_id = content_hash(f"{INDEX_SCHEMA_VERSION}\n{source}\n{parent_id}\n{chunk.metadata['content_hash']}")
+        chunks.setdefault(chunk_id, chunk)
+    
+    # Record ngắn là bình thường; chỉ văn bản chia theo đoạn mới đáng xem lại
+    if splitter.rule_for(source)["mode"] == "sections":
+        short_parents = [parent for parent in parents if len(parent) < 100]
+        if short_parents:
+            logger.debug(f"{source} có {len(short_parents)} đoạn quá ngắn")
+    return chunks
+
+def get_indexed_ids(vectorstore, source=None):
+    # Nhóm id các chunk đang có trong vector DB theo file nguồn
+    result = vectorstore.get(
+        where={"source": source} if source else None,
+        include=["metadatas"]
+    )
+    indexed = {}
+    for chunk_id, metadata in zip(result["ids"], result["metadatas"]):
+        chunk_source = os.path.normpath(str((metadata or {}).get("source", "")))
+        indexed.setdefault(chunk_source, set()).add(chunk_id)
+    return indexed
+
+def iter_file_chunks(sources):
+    # Đọc và split các file song song nhưng chỉ giữ tối đa 2 * INGEST_WORKERS file
+    # trong bộ nhớ cùng lúc; trả về (source, chunks) theo đúng thứ tự sources
+    def load(source):
+        return source, load_file_chunks(source) if os.path.isfile(source) else {}
+    
+    with ThreadPoolExecutor(max_workers=max(1, INGEST_WORKERS)) as executor:
+        in_flight = deque()
+        for source in sources:
+            in_flight.append(executor.submit(load, source))
+            if len(in_flight) >= 2 * max(1, INGEST_WORKERS):
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def sync_index(vectorstore, sources=None, dry_run=False):
+    # Cập nhật vector DB theo từng file: chỉ embed chunk mới hoặc đã thay đổi,
+    # xóa chunk cũ và chunk của file không còn tồn tại.
+    # sources=None nghĩa là đồng bộ toàn bộ tài liệu. Trả về các file có thay đổi.
+    # dry_run: chỉ so sánh, không embed và không sửa vector DB
+    started = time.time()
+    if sources is None:
+        indexed = get_indexed_ids(vectorstore)
+        sources = set(list_source_files()) | set(indexed)
+    else:
+        sources = {os.path.normpath(source) for source in sources}
+        indexed = {}
+        for source in sources:
+            indexed.update(get_indexed_ids(vectorstore, source))
+    
+    changed = set()
+    pending_ids, pending_docs, pending_deletes = [], [], []
+    stats = {"files": 0, "chunks": 0, "embedded": 0, "deleted": 0}
+    
+    def flush(limit):
+        # Embed và thêm các chunk đang chờ theo từng batch EMBED_BATCH_SIZE
+        while len(pending_ids) >= limit and pending_ids:
+            size = min(EMBED_BATCH_SIZE, len(pending_ids))
+            vectorstore.add_documents(pending_docs[:size], ids=pending_ids[:size])
+            del pending_docs[:size], pending_ids[:size]
+            stats["embedded"] += size
+        # Thêm chunk mới trước rồi mới xóa chunk cũ để request đang chạy
+        # không gặp lúc file không còn chunk nào
+        if not pending_ids and pending_deletes:
+            vectorstore.delete(ids=list(pending_deletes))
+            stats["deleted"] += len(pending_deletes)
+            pending_deletes.clear()
+    
+    for source, new_chunks in iter_file_chunks(sorted(sources)):
+        old_ids = indexed.get(source, set())
+        added = [chunk_id for chunk_id in new_chunks if chunk_id not in old_ids]
+        removed = [chunk_id for chunk_id in old_ids if chunk_id not in new_chunks]
+        if dry_run:
+            if added or removed:
+                changed.add(source)
+            continue
+        stats["files"] += 1
+        stats["chunks"] += len(new_chunks)
         
-        # Đường dẫn cố định cho vector database
-        db_path = "C:/FlexFit/vector_db"
-        os.makedirs(db_path, exist_ok=True)
+        pending_ids.extend(added)
+        pending_docs.extend(new_chunks[chunk_id] for chunk_id in added)
+        pending_deletes.extend(removed)
+        flush(EMBED_BATCH_SIZE)
         
-        print(f"\n=== VECTOR DATABASE INFO ===", file=sys.stderr)
-        print(f"Vector DB Path: {db_path}", file=sys.stderr)
+        if added or removed:
+            changed.add(source)
+            logger.debug(f"Index {source}: +{len(added)} / -{len(removed)} chunks")
+    if dry_run:
+        return changed
+    flush(1)
+    
+    if changed:
+        vectorstore.persist()  # Lưu xuống disk
+    
+    elapsed = max(time.time() - started, 1e-6)
+    logger.info(
+        f"Index: {stats['files']} file, {stats['chunks']} chunks, embed {stats['embedded']}, "
+        f"xóa {stats['deleted']} trong {elapsed:.2f}s "
+        f"({stats['files'] / elapsed:.1f} docs/s, {stats['chunks'] / elapsed:.1f} chunks/s, "
+        f"{stats['embedded'] / elapsed:.1f} embedded/s)"
+    )
+    return changed
+
+def validate_index(vectorstore):
+    # Snapshot mới phải có chunk và tìm kiếm được trước khi thay snapshot đang dùng
+    count = len(vectorstore.get(include=["metadatas"])["ids"])
+    if not count:
+        raise Exception("Snapshot mới không có chunk nào")
+    probe = get_embeddings().embed_query("FlexFit")
+    if not vectorstore.similarity_search_by_vector_with_relevance_scores(probe, k=1):
+        raise Exception("Snapshot mới không tìm kiếm được")
+    return count
+
+def build_snapshot(sources, base=None):
+    # Index vào snapshot mới (sao chép từ base), kiểm tra rồi mới đổi CURRENT.
+    # Trả về (vectorstore, phiên bản)
+    snapshots = index_snapshots()
+    version = snapshots.create(base)
+    try:
+        vectorstore = create_vectorstore(snapshots.path(version))
+        sync_index(vectorstore, sources)
+        count = validate_index(vectorstore)
+    except Exception:
+        snapshots.discard(version)
+        raise
+    snapshots.publish(version)
+    logger.info(f"Index: snapshot {version} có {count} chunks")
+    return vectorstore, version
+
+def swap_vectorstore(vectorstore, version):
+    # Request đang chạy giữ vectorstore cũ tới khi xong, request sau dùng bản mới
+    global _vectorstore_cache, _vectorstore_version
+    with _vectorstore_lock:
+        _retire_vectorstore()
+        _vectorstore_cache = vectorstore
+        _vectorstore_version = version
+
+def _retire_vectorstore():
+    # Gọi khi đang giữ _vectorstore_lock, trước khi bỏ vector store đang dùng. Không đóng ngay
+    # vì request đang chạy có thể vẫn đọc; đóng khi cleanup xóa snapshot của nó
+    # hoặc khi đã giữ quá INDEX_RETENTION bản cũ
+    if _vectorstore_cache is None:
+        return
+    _retired_vectorstores[_vectorstore_version] = _vectorstore_cache
+    while len(_retired_vectorstores) > INDEX_RETENTION:
+        close_vectorstore(_retired_vectorstores.popitem(last=False)[1])
+
+def release_snapshot(version):
+    # SnapshotStore.cleanup gọi trước khi xóa thư mục của snapshot
+    with _vectorstore_lock:
+        vectorstore = _retired_vectorstores.pop(version, None)
+    if vectorstore is not None:
+        close_vectorstore(vectorstore)
+
+def close_vectorstore(vectorstore):
+    # Trả file và bộ nhớ của snapshot không còn dùng. chromadb giữ một System cho mỗi
+    # thư mục (không bao giờ tự đóng): dừng nó và bỏ khỏi cache của chromadb
+    try:
+        client = getattr(vectorstore, "_client", None)
+        if client is None:
+            # NumpyVectorStore
+            if hasattr(vectorstore, "close"):
+                vectorstore.close()
+            return
+        system = client._system
+        systems = getattr(type(client), "_identifier_to_system", None)
+        if systems is None:
+            # chromadb 0.4
+            systems = getattr(type(client), "_identifer_to_system", {})
+        systems.pop(getattr(client, "_identifier", None), None)
+        system.stop()
+    except Exception as e:
+        logger.error(f"Không đóng được vector store cũ: {str(e)}")
+
+def refresh_index(sources=None):
+    # Đồng bộ lại vector DB sau khi tài liệu thay đổi (vd: vừa crawl): so sánh với
+    # snapshot hiện tại, nếu có thay đổi thì build snapshot mới thay vì sửa bản đang dùng
+    with _index_build_lock:
+        vectorstore = _load_documents()
+        if vectorstore is None:
+            return set()
+        changed = sync_index(vectorstore, sources, dry_run=True)
+        if not changed:
+            return set()
+        vectorstore, version = build_snapshot(changed, base=_vectorstore_version)
+        swap_vectorstore(vectorstore, version)
+        index_snapshots().cleanup(release=release_snapshot)
+    
+    # Câu trả lời đã cache của các route vừa đổi dữ liệu không còn đúng
+    invalidated = answer_cache.invalidate(
+        routes={route_from_source(source) for source in changed},
+        sources=changed
+    )
+    logger.info(f"Answer cache: xóa {invalidated} câu trả lời cũ")
+    return changed
+
+def _open_current_snapshot():
+    # Mở snapshot CURRENT (có thể vừa được process khác publish), None nếu chưa có
+    global _vectorstore_cache, _vectorstore_version
+    with _vectorstore_lock:
+        version = index_snapshots().current_version()
         
-        # Nếu đã có cache trong memory, sử dụng luôn
-        if _vectorstore_cache is not None:
-            print("Cache: Using memory cache", file=sys.stderr)
-            return _vectorstore_cache
-            
-        # Kiểm tra xem có vector database trong disk không
-        db_file = os.path.join(db_path, "chroma.sqlite3")
-        if os.path.exists(db_file):
-            print(f"Status: Vector DB exists at {db_path}", file=sys.stderr)
-            print(f"DB File Size: {os.path.getsize(db_file)/1024/1024:.2f} MB", file=sys.stderr)
-            
-            embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-            )
-            _vectorstore_cache = Chroma(
-                persist_directory=db_path,
-                embedding_function=embeddings
-            )
+        # Nếu đã có cache trong memory và vẫn là snapshot hiện tại, sử dụng luôn
+        if _vectorstore_cache is not None and _vectorstore_version == version:
+            logger.debug("Cache: Using memory cache")
             return _vectorstore_cache
-            
-        # Nếu chưa có, tạo mới vector database
-        print(f"Status: Creating new Vector DB at {db_path}", file=sys.stderr)
-        
-        base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-        documents_dir = os.path.join(base_dir, 'documents')
-        crawled_data_dir = os.path.join(documents_dir, 'crawled_data')
-        
-        print(f"Loading documents from: {documents_dir}", file=sys.stderr)
-        
-        # Tạo các thư mục nếu chưa tồn tại
-        os.makedirs(documents_dir, exist_ok=True)
-        os.makedirs(crawled_data_dir, exist_ok=True)
-        
-        # Load documents từ cả hai thư mục riêng biệt
-        documents = []
-        
-        # Load từ thư mục documents gốc
-        main_loader = DirectoryLoader(
-            documents_dir,
-            glob="*.txt",  # Chỉ load file trực tiếp trong thư mục documents
-            loader_cls=TextLoader,
-            loader_kwargs={'encoding': 'utf-8'}
-        )
-        documents.extend(main_loader.load())
-        
-        # Load từ thư mục crawled_data
-        crawled_loader = DirectoryLoader(
-            crawled_data_dir,
-            glob="*.txt",
-            loader_cls=TextLoader,
-            loader_kwargs={'encoding': 'utf-8'}
-        )
-        crawled_docs = crawled_loader.load()
         
-        # In ra các file đã load để debug
-        print("Loaded files:", file=sys.stderr)
-        for doc in documents:
-            print(f"- {doc.metadata['source']}", file=sys.stderr)
-        for doc in crawled_docs:
-            print(f"- {doc.metadata['source']}", file=sys.stderr)
+        if version is None:
+            return None
+        logger.info(f"Status: Vector DB snapshot {version} at {DB_PATH}")
+        # Quay lại snapshot đã mở trước đó thì dùng lại vector store cũ (chromadb dùng chung System theo thư mục)
+        vectorstore = _retired_vectorstores.pop(version, None)
+        if vectorstore is None:
+            vectorstore = create_vectorstore(index_snapshots().path(version))
+        _retire_vectorstore()
+        _vectorstore_cache = vectorstore
+        _vectorstore_version = version
+        return _vectorstore_cache
+
+def _load_documents():
+    # Chỉ gọi khi đang giữ _index_build_lock (load_documents, refresh_index)
+    try:
+        logger.debug(f"Vector DB Path: {DB_PATH} ({VECTOR_BACKEND})")
+        vectorstore = _open_current_snapshot()
+        if vectorstore is not None:
+            return vectorstore
             
-        documents.extend(crawled_docs)
+        # Nếu chưa có, tạo snapshot đầu tiên
+        logger.info(f"Status: Creating new Vector DB at {DB_PATH}")
+        logger.debug(f"Loading documents from: {DOCUMENTS_DIR}")
         
-        if not documents:
-            raise Exception(f"Không tìm thấy tài liệu trong thư mục {documents_dir}")
+        source_files = list_source_files()
         
-        # Tăng chunk_size lớn hơn và điều chỉnh cách split
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=4000,  # Tăng lên 4000 ký tự
-            chunk_overlap=400,  # Tăng overlap để đảm bảo không mất context
-            length_function=len,
-            separators=["\n\n\n", "\n\n", "\n", ".", " ", ""],  # Thêm nhiều separators
-            is_separator_regex=False
-        )
-        
-        # In nội dung gốc để debug
-        print("\nNội dung gốc của các file:", file=sys.stderr)
-        for doc in documents:
-            print(f"\nFile: {doc.metadata['source']}", file=sys.stderr)
-            print(f"Độ dài nội dung: {len(doc.page_content)}", file=sys.stderr)
-            print(f"Vài dòng đầu:\n{doc.page_content[:500]}...\n", file=sys.stderr)
-        
-        texts = text_splitter.split_documents(documents)
-        
-        print(f"\nSố lượng chunks sau khi split: {len(texts)}", file=sys.stderr)
-        print("\nKiểm tra các chunks:", file=sys.stderr)
-        for i, text in enumerate(texts):
-            print(f"\nChunk {i+1}:", file=sys.stderr)
-            print(f"Source: {text.metadata['source']}", file=sys.stderr)
-            print(f"Độ dài chunk: {len(text.page_content)}", file=sys.stderr)
-            print(f"Nội dung: {text.page_content[:200]}...", file=sys.stderr)
-        
-        # Kiểm tra xem có chunk nào quá ngắn không
-        short_chunks = [text for text in texts if len(text.page_content) < 100]
-        if short_chunks:
-            print(f"\nCảnh báo: Có {len(short_chunks)} chunks quá ngắn!", file=sys.stderr)
-        
-        # Tạo và persist vector database
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-        )
+        # In ra các file đã load để debug
+        logger.debug("Loaded files:")
+        for source in source_files:
+            logger.debug(f"- {source}")
         
-        vectorstore = Chroma.from_documents(
-            documents=texts,
-            embedding=embeddings,
-            persist_directory=db_path
-        )
-        vectorstore.persist()  # Lưu xuống disk
+        if not source_files:
+            raise Exception(f"Không tìm thấy tài liệu trong thư mục {DOCUMENTS_DIR}")
         
-        _vectorstore_cache = vectorstore
-        print(f"Status: Created new Vector DB at {db_path}", file=sys.stderr)
+        vectorstore, version = build_snapshot(source_files)
+        swap_vectorstore(vectorstore, version)
+        logger.info(f"Status: Created new Vector DB at {DB_PATH}")
         return vectorstore
         
     except Exception as e:
-        print(f"Lỗi khi đọc tài liệu: {str(e)}", file=sys.stderr)
+        logger.error(f"Lỗi khi đọc tài liệu: {str(e)}")
         return None
 
+def vectorstore_exists():
+    # Chỉ kiểm tra file, không import backend (dùng được cho --health)
+    return index_snapshots().current_version() is not None
+
+def create_vectorstore(path):
+    # Mở (hoặc tạo rỗng) vector store theo VECTOR_BACKEND
+    if VECTOR_BACKEND == "numpy":
+        from vector_store import NumpyVectorStore
+        return NumpyVectorStore(path, embedding_function=get_embeddings())
+    from langchain_community.vectorstores import Chroma
+    return Chroma(
+        persist_directory=path,
+        embedding_function=get_embeddings()
+    )
+
+def crawl_website(route):
+    # web_crawler kéo theo BeautifulSoup/requests (và Selenium khi cần render),
+    # chỉ import khi thật sự crawl
+    from web_crawler import crawl_website as crawl
+    return crawl(route)
+
+def crawl_websites(routes):
+    from web_crawler import crawl_websites as crawl
+    return crawl(routes)
+
 def clear_vectorstore_cache():
-    global _vectorstore_cache
-    _vectorstore_cache = None
+    global _vectorstore_cache, _vectorstore_version
+    with _vectorstore_lock:
+        _retire_vectorstore()
+        _vectorstore_cache = None
+        _vectorstore_version = None
 
-def get_response(query, conversation_history=None, stream=False):
-    try:
-        client = init_ai()
-        
-        # Xem xét context hội thoại
-        conversation_context = ""
-        current_topic = None
-        latest_topic = None
-        
-        if conversation_history:
-            # Lấy tin nhắn mới nhất trước
-            latest_message = conversation_history[-1]
-            if latest_message['role'] == 'assistant':
-                # Phân tích chủ đề từ tin nhắn mới nhất
-                if 'gói tập' in latest_message['content'].lower() or 'plan' in latest_message['content'].lower():
-                    latest_topic = 'membership'
-                elif 'lớp' in latest_message['content'].lower() or 'lịch học' in latest_message['content'].lower():
-                    latest_topic = 'classes'
-                elif 'huấn luyện viên' in latest_message['content'].lower() or 'pt' in latest_message['content'].lower():
-                    latest_topic = 'instructors'
-                elif 'bài tập' in latest_message['content'].lower() or 'hướng dẫn tập' in latest_message['content'].lower():
-                    latest_topic = 'practice'
-            
-            # Nếu câu hỏi không rõ ràng, xem xét thêm lịch sử
-            if not any(keyword in query.lower() for keyword in ['lớp', 'pt', 'gói', 'bài tập', 'huấn luyện']):
-                # Xem 3 tin nhắn gần nhất
-                recent_messages = conversation_history[-3:]
-                for msg in recent_messages:
-                    if msg['role'] == 'assistant':
-                        if 'gói tập' in msg['content'].lower() or 'plan' in msg['content'].lower():
-                            current_topic = 'membership'
-                        elif 'lớp' in msg['content'].lower() or 'lịch học' in msg['content'].lower():
-                            current_topic = 'classes'
-                        elif 'huấn luyện viên' in msg['content'].lower() or 'pt' in msg['content'].lower():
-                            current_topic = 'instructors'
-                        elif 'bài tập' in msg['content'].lower() or 'hướng dẫn tập' in msg['content'].lower():
-                            current_topic = 'practice'
-                    conversation_context += f"{msg['role']}: {msg['content']}\n"
-        
-        print(f"Context hội thoại:\n{conversation_context}", file=sys.stderr)
-        print(f"Chủ đề từ tin nhắn mới nhất: {latest_topic}", file=sys.stderr)
-        print(f"Chủ đề từ lịch sử: {current_topic}", file=sys.stderr)
-        
-        # Ưu tiên chủ đề từ tin nhắn mới nhất
-        if latest_topic:
-            current_topic = latest_topic
-        
-        # Phân tích route với context hội thoại
-        analysis_prompt = {
-            "role": "user",
-            "content": f"""Phân tích câu hỏi sau trong context hội thoại:
+async def classify_route_llm(client, query, conversation_context, current_topic):
+    # Phân tích route với context hội thoại
+    analysis_prompt = {
+        "role": "user",
+        "content": f"""Phân tích câu hỏi sau trong context hội thoại:
 
 Câu hỏi hiện tại: "{query}"
 
@@ -231,111 +673,365 @@ Ví dụ:
 - "Tell me about membership" -> membership
 
 Chỉ trả lời tên route phù hợp nhất."""
+    }
+
+    messages = [{
+        "role": "system", 
+        "content": """Bạn là trợ lý phân tích câu hỏi. 
+        1. Ưu tiên giữ nguyên chủ đề nếu câu hỏi yêu cầu thêm thông tin
+        2. Chuyển chủ đề nếu câu hỏi rõ ràng về chủ đề mới
+        3. Chỉ trả lời none khi chắc chắn không liên quan đến các chủ đề"""
+    }]
+
+    messages.append(analysis_prompt)
+    analysis = await client.chat.completions.create(
+        model="gemma2:9b",
+        messages=messages,
+        temperature=0,
+        max_tokens=10
+    )
+
+    route = parse_route(analysis.choices[0].message.content)
+    logger.info(f"Phân tích route (LLM): {route}")
+    return route
+
+def with_distances(results):
+    # Giữ distance trong metadata để xếp hạng chunk khi ghép context
+    for doc, distance in results:
+        doc.metadata["distance"] = distance
+    return [doc for doc, _ in results]
+
+def search_documents(vectorstore, query_embedding, route=None, k=None):
+    # route được đẩy xuống vector DB dưới dạng filter metadata thay vì lọc sau top-k
+    k = k or RETRIEVAL_K
+    search_filter = {"route": route} if route else None
+    if RETRIEVAL_MODE == "mmr":
+        return vectorstore.max_marginal_relevance_search_by_vector(
+            query_embedding, k=k, fetch_k=max(RETRIEVAL_FETCH_K, k), filter=search_filter
+        )
+    return with_distances(
+        vectorstore.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k, filter=search_filter)
+    )
+
+async def asearch_documents(vectorstore, query_embedding, route=None, k=None):
+    # MMR cần cả vector của các chunk nên không gom batch
+    if _search_batcher is None or RETRIEVAL_MODE == "mmr":
+        return await asyncio.to_thread(search_documents, vectorstore, query_embedding, route, k)
+    search_filter = {"route": route} if route else None
+    return await asyncio.wrap_future(
+        _search_batcher.enqueue((vectorstore, query_embedding, search_filter, k or RETRIEVAL_K))
+    )
+
+def query_chroma(vectorstore, query_embeddings, k, search_filter):
+    # Một truy vấn Chroma cho nhiều câu hỏi có cùng filter và k
+    from langchain.schema import Document
+    result = vectorstore._collection.query(
+        query_embeddings=query_embeddings,
+        n_results=k,
+        where=search_filter,
+        include=["documents", "metadatas", "distances"]
+    )
+    return [
+        [
+            (Document(page_content=text, metadata=metadata or {}), distance)
+            for text, metadata, distance in zip(texts, metadatas, distances)
+        ]
+        for texts, metadatas, distances in zip(result["documents"], result["metadatas"], result["distances"])
+    ]
+
+def search_documents_batch(items):
+    # items: [(vectorstore, query_embedding, filter, k)], trả về docs theo đúng thứ tự
+    results = [None] * len(items)
+    groups = {}
+    for i, (vectorstore, _, search_filter, k) in enumerate(items):
+        if hasattr(vectorstore, "batch_similarity_search_by_vectors_with_relevance_scores"):
+            # NumPy: cả batch là một phép nhân ma trận, filter áp dụng riêng từng câu
+            key = (id(vectorstore),)
+        else:
+            key = (id(vectorstore), json.dumps(search_filter, sort_keys=True), k)
+        groups.setdefault(key, []).append(i)
+    
+    for indexes in groups.values():
+        vectorstore = items[indexes[0]][0]
+        embeddings = [items[i][1] for i in indexes]
+        if hasattr(vectorstore, "batch_similarity_search_by_vectors_with_relevance_scores"):
+            batch = vectorstore.batch_similarity_search_by_vectors_with_relevance_scores(
+                embeddings, [items[i][3] for i in indexes], [items[i][2] for i in indexes]
+            )
+        elif hasattr(vectorstore, "_collection"):
+            batch = query_chroma(vectorstore, embeddings, items[indexes[0]][3], items[indexes[0]][2])
+        else:
+            batch = [
+                vectorstore.similarity_search_by_vector_with_relevance_scores(embedding, k=items[i][3], filter=items[i][2])
+                for i, embedding in zip(indexes, embeddings)
+            ]
+        for i, scored in zip(indexes, batch):
+            results[i] = with_distances(scored)
+    return results
+
+def fallback_documents(docs, route):
+    # Câu hỏi chung (route=none) thì ưu tiên gym_info
+    if route == "none":
+        return [doc for doc in docs if doc.metadata.get("route") == "gym_info"] or docs
+    
+    # Không có tài liệu của route: xếp kết quả tìm chung theo thứ tự ưu tiên các route còn lại
+    other_routes = [other_route for other_route in FALLBACK_ROUTES if other_route != route]
+    relevant_docs = sorted(
+        (doc for doc in docs if doc.metadata.get("route") in other_routes),
+        key=lambda doc: other_routes.index(doc.metadata["route"])
+    )
+    for other_route in dict.fromkeys(doc.metadata["route"] for doc in relevant_docs):
+        logger.debug(f"Tìm thấy thông tin liên quan trong route: {other_route}")
+    return relevant_docs or docs
+
+def crawl_and_refresh(route):
+    crawl_success = crawl_website(route)
+    # Chỉ index lại file vừa crawl, các chunk không đổi giữ nguyên embedding
+    return crawl_success and refresh_index([crawled_file_path(route)])
+
+def start_speculative_retrieval(query, query_embedding, likely_route, trace):
+    # Chạy trong lúc chờ router LLM: tìm không lọc route và tìm trong route được đoán.
+    # Route được đoán mà chưa có dữ liệu thì báo scheduler crawl luôn, không đợi router
+    async def run():
+        with trace.span("speculative_retrieval"):
+            vectorstore = await asyncio.to_thread(load_documents)
+            if vectorstore is None:
+                return None
+            embedding = query_embedding if query_embedding is not None else await aembed_query(query)
+            k = max(SPECULATIVE_K, RETRIEVAL_K)
+            searches = [asearch_documents(vectorstore, embedding, k=k)]
+            if likely_route not in (None, "none"):
+                searches.append(asearch_documents(vectorstore, embedding, likely_route))
+            results = await asyncio.gather(*searches)
+        likely_docs = results[1] if len(results) > 1 else None
+        if not likely_docs and likely_route in CRAWLABLE_ROUTES and \
+                _refresh_scheduler is not None and _refresh_scheduler.running:
+            _refresh_scheduler.request(likely_route)
+        return {
+            "embedding": embedding,
+            "candidates": results[0],
+            # Ít hơn k kết quả nghĩa là đã có toàn bộ index
+            "complete": len(results[0]) < k,
+            "likely_route": likely_route,
+            "likely_docs": likely_docs
         }
+    return asyncio.create_task(run())
+
+async def speculation_result(speculation):
+    # Kết quả của start_speculative_retrieval, None nếu lỗi (khi đó tìm lại theo route)
+    try:
+        return await speculation
+    except Exception as e:
+        logger.warning(f"Tìm kiếm song song lỗi, tìm lại theo route: {str(e)}")
+        return None
+
+def speculative_route_documents(speculative, route):
+    # Docs của route lấy từ kết quả tìm trước, None nếu chưa chắc đủ và phải tìm lại.
+    # Có đủ k chunk của route trong top kết quả không lọc (hoặc đã có cả index)
+    # thì đó chính là top-k khi lọc theo route
+    if route == "none":
+        return []
+    if route == speculative["likely_route"] and speculative["likely_docs"] is not None:
+        return speculative["likely_docs"]
+    docs = [doc for doc in speculative["candidates"] if doc.metadata.get("route") == route][:RETRIEVAL_K]
+    return docs if len(docs) == RETRIEVAL_K or speculative["complete"] else None
+
+async def retrieve_documents(vectorstore, query, query_embedding, route, trace, speculative=None):
+    # Embedding câu hỏi, tìm theo route, crawl (chỉ khi không có scheduler)
+    # và fallback sang các route khác. Trả về (docs, query_embedding).
+    # speculative: kết quả của start_speculative_retrieval, dùng lại khi đủ
+    with trace.span("retrieval"):
+        route_docs = None
+        if speculative is not None:
+            query_embedding = speculative["embedding"]
+            route_docs = speculative_route_documents(speculative, route)
+            trace.set(speculative_hit=route_docs is not None)
+        if query_embedding is None:
+            query_embedding = await aembed_query(query)
         
-        messages = [{
-            "role": "system", 
-            "content": """Bạn là trợ lý phân tích câu hỏi. 
-            1. Ưu tiên giữ nguyên chủ đề nếu câu hỏi yêu cầu thêm thông tin
-            2. Chuyển chủ đề nếu câu hỏi rõ ràng về chủ đề mới
-            3. Chỉ trả lời none khi chắc chắn không liên quan đến các chủ đề"""
-        }]
+        # Tìm trong đúng route trước (lọc ngay trong vector DB theo metadata route)
+        if route_docs is None:
+            route_docs = await asearch_documents(vectorstore, query_embedding, route) if route != "none" else []
+    
+    if not route_docs and route in CRAWLABLE_ROUTES:  # Nếu chưa có dữ liệu của route này
+        if _refresh_scheduler is not None and _refresh_scheduler.running:
+            # Crawl ở nền, request này trả lời bằng index hiện có
+            _refresh_scheduler.request(route)
+        else:
+            logger.info(f"Tiến hành crawl route: {route}")
+            with trace.span("crawl"):
+                changed = await asyncio.to_thread(crawl_and_refresh, route)
+            if changed:
+                # Index đã đổi sang snapshot mới, kết quả tìm trước và store cũ không còn đúng
+                speculative = None
+                vectorstore = await asyncio.to_thread(load_documents) or vectorstore
+                with trace.span("retrieval"):
+                    route_docs = await asearch_documents(vectorstore, query_embedding, route)
+    
+    if route_docs:
+        return route_docs, query_embedding
+    
+    with trace.span("retrieval"):
+        if route != "none":
+            logger.info(f"Không tìm thấy thông tin trong {route}, tìm kiếm ở các route khác...")
+        if speculative is not None:
+            docs = speculative["candidates"][:RETRIEVAL_K]
+        else:
+            docs = await asearch_documents(vectorstore, query_embedding)
+        return fallback_documents(docs, route), query_embedding
+
+def replay_cached_answer(entry, stream, emit):
+    # Trả lại câu trả lời đã cache, khi stream thì phát lại dưới dạng các token
+    if not stream:
+        return json.dumps({
+            "response": entry["answer"],
+            "context": entry["context"]
+        })
+    
+    emit({
+        "type": "context",
+        "content": entry["context"]
+    })
+    for token in re.findall(r"\S*\s*", entry["answer"]):
+        if token:
+            emit({
+                "type": "token",
+                "content": token
+            })
+
+def get_response(query, conversation_history=None, stream=False, emit=None, request_id=None, conversation_id=None):
+    # Bản đồng bộ cho CLI, chạy pipeline async trên một event loop riêng
+    return asyncio.run(aget_response(query, conversation_history, stream, emit, request_id, conversation_id))
+
+async def aget_response(query, conversation_history=None, stream=False, emit=None, request_id=None, conversation_id=None):
+    # emit nhận từng event khi stream; mặc định ghi ra stdout.
+    # Token được gom thành frame nhỏ, mỗi request có một trace đo thời gian từng bước
+    emit = emit or emit_stdout
+    trace = Trace(request_id)
+    trace.set(stream=stream)
+    frames = TokenFrames(emit)
+    
+    def traced_emit(event):
+        if event.get("type") == "token":
+            trace.mark("ttft")
+            frames.add(event["content"])
+            return
+        frames.flush()
+        if event.get("type") == "error":
+            trace.set(status="error")
+        emit(event)
+    
+    try:
+        if conversation_id is not None:
+            # Client chỉ gửi tin nhắn mới, lịch sử nằm ở server
+            conversation = conversations.get(conversation_id)
+            if conversation_history and not conversation.history():
+                for message in conversation_history:
+                    conversation.add(message["role"], message["content"])
+        else:
+            conversation = Conversation.from_history(conversation_history, window=SESSION_WINDOW)
+        return await _aget_response(query, conversation, stream, traced_emit, trace)
+    except asyncio.CancelledError:
+        # Client đã ngắt kết nối: câu trả lời dở không được lưu vào hội thoại hay cache
+        trace.set(status="cancelled")
+        frames.buffer, frames.size = [], 0
+        raise
+    finally:
+        frames.flush()
+        trace.finish()
+
+async def _aget_response(query, conversation, stream, emit, trace):
+    # Task tìm song song và task retrieval bị hủy ở finally nếu request kết thúc sớm
+    speculation = None
+    retrieval = None
+    try:
+        client = get_ai_client()
         
-        messages.append(analysis_prompt)
-        analysis = client.chat.completions.create(
-            model="gemma2:9b",
-            messages=messages,
-            temperature=0,
-            max_tokens=10
-        )
+        # Chủ đề và context hội thoại đã được phân tích dần khi thêm từng tin nhắn
+        current_topic, conversation_context = conversation.topic_context(query)
+        history = conversation.history()
+        summary = conversation.summary_text()
+        
+        logger.debug(f"Context hội thoại:\n{conversation_context}")
+        logger.debug(f"Chủ đề hiện tại: {current_topic}")
         
-        route = analysis.choices[0].message.content.strip().lower()
-        print(f"Phân tích route: {route}", file=sys.stderr)
+        with trace.span("routing"):
+            # Router cục bộ bằng embedding, chỉ gọi gemma2:9b khi không đủ tự tin
+            route = None
+            likely_route = None
+            # Câu hỏi lặp lại trong cùng hội thoại dùng lại embedding đã tính
+            query_embedding = conversation.get_embedding(query)
+            router = await asyncio.to_thread(get_route_classifier)
+            if router is not None:
+                if query_embedding is None:
+                    query_embedding = await aembed_query(query)
+                route, score, margin = router.classify(query_embedding)
+                logger.info(f"Phân tích route (local): {route} (score={score:.3f}, margin={margin:.3f})")
+                if route is None:
+                    likely_route = router.likely_route(query_embedding)
+            if route is None:
+                # Tìm kiếm không phụ thuộc route nên chạy song song với router LLM;
+                # MMR chọn theo cả tập kết quả nên không lọc lại theo route được
+                if SPECULATIVE_RETRIEVAL and RETRIEVAL_MODE != "mmr":
+                    speculation = start_speculative_retrieval(query, query_embedding, likely_route, trace)
+                route = await classify_route_llm(client, query, conversation_context, current_topic)
+                trace.set(router="llm")
+            else:
+                trace.set(router="local")
         
         # Nếu câu hỏi yêu cầu thêm thông tin và có chủ đề hiện tại
+        route_from_context = False
         if route == "none" and current_topic and any(phrase in query.lower() for phrase in 
             ["chi tiết", "thêm", "cụ thể", "nữa", "còn gì", "như thế nào"]):
             route = current_topic
-            print(f"Đã cập nhật route theo context: {route}", file=sys.stderr)
+            route_from_context = True
+            logger.info(f"Đã cập nhật route theo context: {route}")
+        trace.set(route=route)
+        
+        speculative = None
+        with trace.span("cache_lookup"):
+            # Câu hỏi nối tiếp phụ thuộc vào hội thoại nên không dùng cache
+            use_cache = answer_cache.enabled and not route_from_context
+            cached = None
+            if use_cache:
+                cached = answer_cache.get(query, route)
+                if cached is None and answer_cache.semantic_enabled:
+                    if query_embedding is None and speculation is not None:
+                        # Không có router cục bộ: embedding đã được tính trong lúc tìm song song
+                        speculative = await speculation_result(speculation)
+                        speculation = None
+                        if speculative is not None:
+                            query_embedding = speculative["embedding"]
+                    if query_embedding is None:
+                        query_embedding = await aembed_query(query)
+                    cached = answer_cache.get(query, route, query_embedding)
+            trace.set(cache_hit=cached is not None)
+            if cached is not None:
+                logger.info(f"Answer cache: hit ({route})")
+                conversation.add_turn(query, cached["answer"])
+                return replay_cached_answer(cached, stream, emit)
         
         # Load documents hiện có trước
-        vectorstore = load_documents()
+        vectorstore = await asyncio.to_thread(load_documents)
         if vectorstore is None:
             error_msg = {"type": "error", "content": "Không tìm thấy tài liệu"}
+            trace.set(status="error")
             if stream:
-                print(json.dumps(error_msg))
-                sys.stdout.flush()
+                emit(error_msg)
                 return
             return json.dumps(error_msg)
             
-        # Chỉ xóa cache khi có crawl dữ liệu mới
-        if route in ["classes", "practice", "instructors", "membership"]:
-            docs = vectorstore.similarity_search(query, k=5)
-            route_docs = [doc for doc in docs if route in str(doc.metadata.get("source", "")).lower()]
+        if speculation is not None:
+            speculative = await speculation_result(speculation)
             
-            if not route_docs:  # Nếu chưa có dữ liệu của route này
-                print(f"Tiến hành crawl route: {route}", file=sys.stderr)
-                crawl_success = crawl_website(route)
-                if crawl_success:
-                    # Xóa cả memory cache và disk cache
-                    clear_vectorstore_cache()
-                    db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))), 'chroma_db')
-                    if os.path.exists(db_path):
-                        import shutil
-                        shutil.rmtree(db_path)
-                    vectorstore = load_documents()
-        
-        # Tìm kiếm với k=5 để có nhiều context hơn
-        docs = vectorstore.similarity_search(query, k=5)
-        
-        # Xử lý context dựa trên route
-        if route != "none":
-            # Nếu là route cụ thể, ưu tiên tìm trong file tương ứng
-            relevant_docs = [
-                doc for doc in docs 
-                if route in str(doc.metadata.get("source", "")).lower()
-            ]
-            
-            # Nếu không tìm thấy trong route hiện tại, tìm ở các route khác
-            if not relevant_docs:
-                print(f"Không tìm thấy thông tin trong {route}, tìm kiếm ở các route khác...", file=sys.stderr)
-                # Thử tìm trong các route khác
-                other_routes = ["classes", "practice", "instructors", "membership", "guide", "gym_info"]
-                
-                # Kiểm tra xem route có trong danh sách không trước khi xóa
-                if route in other_routes:
-                    other_routes.remove(route)
-                
-                for other_route in other_routes:
-                    other_docs = [
-                        doc for doc in docs 
-                        if other_route in str(doc.metadata.get("source", "")).lower()
-                    ]
-                    if other_docs:
-                        print(f"Tìm thấy thông tin liên quan trong route: {other_route}", file=sys.stderr)
-                        relevant_docs.extend(other_docs)
-                
-                # Thêm cả thông tin từ gym_info.txt
-                gym_info_docs = [
-                    doc for doc in docs 
-                    if "gym_info.txt" in str(doc.metadata.get("source", "")).lower()
-                ]
-                if gym_info_docs:
-                    relevant_docs.extend(gym_info_docs)
-            
-            if relevant_docs:
-                docs = relevant_docs
-        else:
-            # Nếu là câu hỏi chung (route=none), ưu tiên tìm trong gym_info.txt
-            gym_info_docs = [
-                doc for doc in docs 
-                if "gym_info.txt" in str(doc.metadata.get("source", "")).lower()
-            ]
-            if gym_info_docs:
-                docs = gym_info_docs
+        # Tìm tài liệu trong lúc chuẩn bị phần prompt không phụ thuộc context;
+        # sleep(0) để task kịp gửi embedding/tìm kiếm đi trước khi build prompt
+        retrieval = asyncio.create_task(
+            retrieve_documents(vectorstore, query, query_embedding, route, trace, speculative)
+        )
+        await asyncio.sleep(0)
         
-        context = "\n".join([doc.page_content for doc in docs])
-        print(f"Context tìm được:\n{context}", file=sys.stderr)
+        prompt_started = time.perf_counter()
         
         # Cải thiện system prompt
         messages = [{
@@ -346,13 +1042,23 @@ Chỉ trả lời tên route phù hợp nhất."""
             3. Nói rõ nếu không có thông tin"""
         }]
         
-        # Thêm lịch sử hội thoại nếu có
-        if conversation_history:
-            for msg in conversation_history[-3:]:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
+        # Tóm tắt các tin nhắn cũ và lịch sử gần nhất, cắt bớt để vừa giới hạn token
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": "Tóm tắt phần hội thoại trước:\n" + context_builder.truncate(summary, context_builder.history_tokens // 2)
+            })
+        if history:
+            messages.extend(context_builder.fit_history(history, max_messages=3))
+        trace.record("prompt_build", prompt_started)
+        
+        docs, query_embedding = await retrieval
+        conversation.put_embedding(query, query_embedding)
+        
+        prompt_started = time.perf_counter()
+        # Bỏ phần overlap giữa các chunk và giữ context trong giới hạn token
+        context, passages = context_builder.build(docs)
+        logger.debug(f"Context tìm được:\n{context}")
         
         # Tạo prompt cuối cùng với context
         final_prompt = f"""Dựa trên thông tin sau:
@@ -367,61 +1073,346 @@ Chỉ trả lời tên route phù hợp nhất."""
             "content": final_prompt
         })
         
+        trace.record("prompt_build", prompt_started)
+        trace.set(docs=len(docs), passages=passages, context_chars=len(context),
+                  context_tokens=context_builder.count_tokens(context))
+        
         try:
-            response = client.chat.completions.create(
+            generation_started = time.perf_counter()
+            max_tokens = ROUTE_MAX_TOKENS.get(route, GENERATION_MAX_TOKENS)
+            trace.set(max_tokens=max_tokens)
+            response = await client.chat.completions.create(
                 model="gemma2:2b",
                 messages=messages,
                 stream=stream,
                 temperature=0.7,
-                max_tokens=1000
+                max_tokens=max_tokens,
+                stop=GENERATION_STOP
             )
             
+            sources = {str(doc.metadata.get("source", "")) for doc in docs}
+            
             if stream:
-                print(json.dumps({
+                emit({
                     "type": "context",
                     "content": context
-                }))
-                sys.stdout.flush()
+                })
                 
-                for chunk in response:
-                    if chunk.choices[0].delta.content:
-                        print(json.dumps({
-                            "type": "token",
-                            "content": chunk.choices[0].delta.content
-                        }))
-                        sys.stdout.flush()
+                answer = []
+                try:
+                    async for chunk in response:
+                        if chunk.choices[0].delta.content:
+                            answer.append(chunk.choices[0].delta.content)
+                            emit({
+                                "type": "token",
+                                "content": chunk.choices[0].delta.content
+                            })
+                        if chunk.choices[0].finish_reason:
+                            # "length" nghĩa là câu trả lời bị cắt ở max_tokens
+                            trace.set(finish_reason=chunk.choices[0].finish_reason)
+                finally:
+                    # Đóng kết nối để Ollama dừng sinh ngay, kể cả khi request bị hủy giữa chừng
+                    await response.close()
+                
+                trace.record("generation", generation_started)
+                answer = "".join(answer)
+                conversation.add_turn(query, answer)
+                if use_cache:
+                    answer_cache.put(query, route, answer, context, sources, query_embedding)
             else:
+                trace.mark("ttft")
+                trace.record("generation", generation_started)
+                answer = response.choices[0].message.content
+                trace.set(finish_reason=response.choices[0].finish_reason)
+                conversation.add_turn(query, answer)
+                if use_cache:
+                    answer_cache.put(query, route, answer, context, sources, query_embedding)
                 return json.dumps({
-                    "response": response.choices[0].message.content,
+                    "response": answer,
                     "context": context
                 })
                 
         except Exception as e:
             error_msg = {"type": "error", "content": f"AI Error: {str(e)}"}
+            trace.set(status="error")
+            logger.error(error_msg["content"])
             if stream:
-                print(json.dumps(error_msg))
-                sys.stdout.flush()
+                emit(error_msg)
                 return
             return json.dumps(error_msg)
             
     except Exception as e:
         error_msg = {"type": "error", "content": f"System Error: {str(e)}"}
+        trace.set(status="error")
+        logger.exception(error_msg["content"])
         if stream:
-            print(json.dumps(error_msg))
-            sys.stdout.flush()
+            emit(error_msg)
             return
         return json.dumps(error_msg)
+    finally:
+        for task in (speculation, retrieval):
+            if task is not None and not task.done():
+                task.cancel()
+
+async def handle_request(request):
+    # Xử lý một request của chế độ server, mọi event đều gắn id của request
+    request_id = request.get("id")
+    
+    def emit(event):
+        emit_stdout({"id": request_id, **event})
+    
+    try:
+        op = request.get("op")
+        if op == "metrics":
+            # Số liệu gom từ mọi request, định dạng Prometheus text
+            emit({"type": "metrics", "content": metrics.render_prometheus()})
+            return
+        if op == "metrics_raw":
+            # Chế độ pre-fork: process cha cộng số liệu của các worker
+            emit({"type": "metrics_raw", "content": metrics.snapshot()})
+            return
+        if op == "reload":
+            # Chế độ pre-fork: process cha vừa cập nhật index, đọc lại index và bỏ cache cũ
+            clear_vectorstore_cache()
+            sources = set(request.get("sources") or [])
+            answer_cache.invalidate(routes={route_from_source(source) for source in sources}, sources=sources)
+            return
+        
+        query = request["query"]
+        history = request.get("history") or []
+        conversation_id = request.get("conversation_id")
+        if request.get("stream", True):
+            await aget_response(query, history, stream=True, emit=emit, request_id=request_id,
+                                conversation_id=conversation_id)
+        else:
+            result = await aget_response(query, history, stream=False, request_id=request_id,
+                                         conversation_id=conversation_id)
+            emit({"type": "result", **json.loads(result)})
+    except Exception as e:
+        emit({"type": "error", "content": f"System Error: {str(e)}"})
+    finally:
+        emit({"type": "done"})
+
+def warm_up():
+    # Load model embedding, router và vector DB, rồi đồng bộ các file
+    # đã thêm/sửa/xóa kể từ lần index trước
+    get_embeddings()
+    get_route_classifier()
+    load_documents()
+    refresh_index()
+
+def start_refresh_scheduler(refresh=refresh_index):
+    # Crawl trước tất cả route ở nền và crawl lại định kỳ
+    global _refresh_scheduler
+    if CRAWL_ROUTES:
+        _refresh_scheduler = RefreshScheduler(
+            CRAWL_ROUTES,
+            crawl=crawl_websites,
+            refresh=refresh,
+            source_for_route=crawled_file_path,
+            interval=REFRESH_INTERVAL
+        )
+        _refresh_scheduler.start()
+
+async def serve(prefork_worker=False):
+    # Chế độ server: đọc request JSON từ stdin (mỗi dòng một request),
+    # model embedding và vector DB chỉ load một lần rồi dùng lại cho mọi request.
+    # Mọi request chạy chung một event loop, các bước blocking chạy trên thread pool.
+    # Worker của chế độ pre-fork đã có sẵn model/index từ process cha
+    global _embed_batcher, _search_batcher
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=SERVER_WORKERS))
+    
+    if not prefork_worker:
+        logger.info(f"=== RAG SERVER: {SERVER_CONCURRENCY} requests, {SERVER_WORKERS} threads ===")
+        await asyncio.to_thread(warm_up)
+        start_refresh_scheduler()
+    
+    if BATCH_WINDOW_MS > 0:
+        _embed_batcher = MicroBatcher(embed_queries, BATCH_MAX_SIZE, BATCH_WINDOW_MS / 1000, name="embed")
+        _search_batcher = MicroBatcher(search_documents_batch, BATCH_MAX_SIZE, BATCH_WINDOW_MS / 1000, name="search")
+    
+    emit_stdout({"type": "ready"})
+    
+    slots = asyncio.Semaphore(SERVER_CONCURRENCY)
+    tasks = set()
+    # Task của từng request theo id, để hủy khi client ngắt kết nối
+    running = {}
+    
+    async def run(request):
+        try:
+            await slots.acquire()
+        except asyncio.CancelledError:
+            # Bị hủy khi còn chờ slot, handle_request chưa chạy nên tự báo done
+            emit_stdout({"id": request.get("id"), "type": "done"})
+            raise
+        try:
+            await handle_request(request)
+        finally:
+            slots.release()
+    
+    # Đọc stdin bằng thread riêng để không chặn event loop
+    stdin_reader = ThreadPoolExecutor(max_workers=1)
+    while True:
+        line = await loop.run_in_executor(stdin_reader, sys.stdin.readline)
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Request không hợp lệ: {str(e)}")
+            continue
+        if request.get("op") == "cancel":
+            # {"op": "cancel", "id": ...}: hủy request đang chạy hoặc đang chờ slot,
+            # request đó vẫn kết thúc bằng event done
+            task = running.get(request.get("id"))
+            if task is not None:
+                logger.info(f"Hủy request {request.get('id')}")
+                task.cancel()
+            continue
+        task = asyncio.create_task(run(request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        if request.get("id") is not None:
+            running[request["id"]] = task
+            task.add_done_callback(lambda _, request_id=request["id"]: running.pop(request_id, None))
+    
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def run_worker(index):
+    # Chạy trong process worker ngay sau fork. Chỉ thread đã gọi fork còn sống nên
+    # các lock mà thread khác của process cha đang giữ phải tạo lại; kết nối SQLite
+    # và client Chroma cũng không dùng chung được qua fork
+    global _stdout_lock, _index_build_lock, _refresh_scheduler, _embed_batcher, _search_batcher
+    _stdout_lock = threading.Lock()
+    _index_build_lock = threading.Lock()
+    metrics.lock = threading.Lock()
+    _embed_batcher = _search_batcher = None
+    if isinstance(_embeddings_cache, CachedEmbeddings):
+        _embeddings_cache.reopen()
+    if VECTOR_BACKEND != "numpy":
+        # Đóng luôn bản sao client của process cha để chromadb tạo System mới cho worker
+        with _vectorstore_lock:
+            clear_vectorstore_cache()
+            while _retired_vectorstores:
+                close_vectorstore(_retired_vectorstores.popitem()[1])
+    _refresh_scheduler = RemoteScheduler(emit_stdout)
+    if "torch" in sys.modules and WORKER_TORCH_THREADS > 0:
+        sys.modules["torch"].set_num_threads(WORKER_TORCH_THREADS)
+    logger.info(f"Worker {index} (pid {os.getpid()}) sẵn sàng")
+    asyncio.run(serve(prefork_worker=True))
+
+def serve_prefork(processes):
+    # Load model và index một lần ở process cha rồi fork các worker; cha chỉ chia
+    # request, chuyển event của worker ra stdout và chạy crawl/refresh nền
+    logger.info(f"=== RAG SERVER: {processes} processes x {SERVER_CONCURRENCY} requests, queue {SERVER_QUEUE} ===")
+    if VECTOR_BACKEND != "numpy":
+        # Client Chroma không dùng được qua fork nên mỗi worker mở lại index: RAM index nhân theo số worker
+        logger.warning(
+            f"RAG_VECTOR_BACKEND={VECTOR_BACKEND}: {processes} worker mỗi worker giữ một bản index riêng, "
+            f"dùng RAG_VECTOR_BACKEND=numpy để các worker dùng chung index"
+        )
+    warm_up()
+    # Đưa các object đã load ra khỏi tầm của GC để GC không ghi vào (và copy) các trang dùng chung
+    gc.freeze()
+    
+    pool = WorkerPool(
+        processes,
+        worker_main=run_worker,
+        emit=emit_stdout,
+        capacity=SERVER_CONCURRENCY,
+        max_queue=SERVER_QUEUE,
+        fork_lock=_vectorstore_lock,
+        on_schedule=lambda route: _refresh_scheduler is not None and _refresh_scheduler.request(route)
+    )
+    
+    def refresh_and_reload(sources=None):
+        changed = refresh_index(sources)
+        if changed:
+            pool.broadcast({"op": "reload", "sources": sorted(changed)})
+        return changed
+    
+    pool.start()
+    start_refresh_scheduler(refresh=refresh_and_reload)
+    emit_stdout({"type": "ready"})
+    pool.run(sys.stdin)
+
+def run_server(processes=SERVER_PROCESSES):
+    if processes > 1 and not hasattr(os, "fork"):
+        logger.warning("Hệ điều hành không hỗ trợ fork, chạy server một process")
+        processes = 1
+    if processes > 1:
+        serve_prefork(processes)
+    else:
+        asyncio.run(serve())
+
+def check_health():
+    # Kiểm tra nhanh không cần load model: Ollama có phản hồi không, đã có đủ model chưa,
+    # index đã được build chưa, và thời gian import module có trong ngân sách không
+    import urllib.request
+    warnings = []
+    health = {"import_ms": round(IMPORT_MS, 1), "import_budget_ms": IMPORT_BUDGET_MS}
+    if IMPORT_MS > IMPORT_BUDGET_MS:
+        warnings.append(f"Import rag_service mất {IMPORT_MS:.0f}ms (ngân sách {IMPORT_BUDGET_MS:.0f}ms)")
+    
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(OLLAMA_BASE_URL.rstrip('/') + '/models', timeout=HEALTH_TIMEOUT) as response:
+            models = [model.get("id") for model in json.loads(response.read()).get("data", [])]
+        missing = [model for model in ("gemma2:2b", "gemma2:9b") if model not in models]
+        health["ollama"] = {
+            "reachable": True,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "missing_models": missing
+        }
+        if missing:
+            warnings.append(f"Ollama chưa có model: {', '.join(missing)}")
+    except Exception as e:
+        health["ollama"] = {"reachable": False, "error": str(e)}
+        warnings.append(f"Không kết nối được Ollama tại {OLLAMA_BASE_URL}")
+    
+    health["index"] = {
+        "path": DB_PATH,
+        "backend": VECTOR_BACKEND,
+        "exists": vectorstore_exists(),
+        "snapshot": index_snapshots().current_version()
+    }
+    if not health["index"]["exists"]:
+        warnings.append("Chưa có vector DB, lần chạy đầu sẽ build index")
+    
+    health["status"] = "ok" if health["ollama"]["reachable"] else "error"
+    health["warnings"] = warnings
+    return health
+
+IMPORT_MS = (time.perf_counter() - _import_started) * 1000
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("query", help="Input query")
+    parser.add_argument("query", nargs="?", help="Input query")
     parser.add_argument("--stream", type=bool, default=False, help="Enable streaming")
     parser.add_argument("--history", type=str, default="[]", help="Conversation history")
+    parser.add_argument("--server", action="store_true", help="Run as a resident JSON-lines server on stdin/stdout")
+    parser.add_argument("--workers", type=int, default=SERVER_PROCESSES, help="Number of pre-forked server processes")
+    parser.add_argument("--health", action="store_true", help="Check Ollama and the vector index, then exit")
     args = parser.parse_args()
     
+    if args.health:
+        health = check_health()
+        print(json.dumps(health, ensure_ascii=False))
+        sys.exit(0 if health["status"] == "ok" else 1)
+    if args.server:
+        run_server(args.workers)
+        sys.exit(0)
+    if args.query is None:
+        parser.error("query is required unless --server is used")
+    
     conversation_history = json.loads(args.history)
     
     if args.stream:
         get_response(args.query, conversation_history, stream=True)
     else:
-        print(get_response(args.query, conversation_history, stream=False)) 
\ No newline at end of file
+        print(get_response(args.query, conversation_history, stream=False))
@@ -0,0 +1,79 @@
+import threading
+import time
+from tracing import get_logger
+
+logger = get_logger('rag.scheduler')
+
+class RefreshScheduler:
+    # Crawl và index lại các route trong một thread nền để request chat chỉ
+    # phải đọc index đã build sẵn. Chạy một lượt ngay khi start, sau đó lặp
+    # lại theo interval (giây, 0 = chỉ chạy lúc start) hoặc khi có route được yêu cầu.
+    def __init__(self, routes, crawl, refresh, source_for_route, interval=3600):
+        self.routes = list(routes)
+        self.crawl = crawl
+        self.refresh = refresh
+        self.source_for_route = source_for_route
+        self.interval = interval
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_run = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        with self.lock:
+            self.pending.update(self.routes)
+        self.thread = threading.Thread(target=self._loop, name="refresh-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def request(self, route):
+        # Không chặn request gọi tới, route sẽ được crawl ở lượt kế tiếp
+        with self.lock:
+            if route in self.pending:
+                return
+            self.pending.add(route)
+        logger.info(f"Scheduler: đã xếp lịch crawl {route}")
+        self.wakeup.set()
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                routes, self.pending = self.pending, set()
+            if routes:
+                self.run_once(routes)
+
+            timeout = None
+            if self.interval > 0:
+                timeout = max(0, self.last_run + self.interval - time.time()) if self.last_run else self.interval
+            if not self.wakeup.wait(timeout):
+                # Hết interval, lên lịch crawl lại toàn bộ route
+                with self.lock:
+                    self.pending.update(self.routes)
+            self.wakeup.clear()
+
+    def run_once(self, routes):
+        started = time.time()
+        try:
+            results = self.crawl(sorted(routes))
+            sources = [self.source_for_route(route) for route, success in results.items() if success]
+            # refresh chỉ embed lại các chunk có hash thay đổi
+            changed = self.refresh(sources) if sources else set()
+            logger.info(
+                f"Scheduler: crawl {len(routes)} route, {len(sources)} thành công, "
+                f"{len(changed)} file thay đổi ({time.time() - started:.1f}s)"
+            )
+        except Exception as e:
+            logger.error(f"Scheduler lỗi: {str(e)}")
+        finally:
+            self.last_run = time.time()
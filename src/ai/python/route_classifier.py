@@ -0,0 +1,133 @@
+import math
+
+ROUTES = ["guide", "classes", "practice", "instructors", "membership", "gym_info", "none"]
+
+# Câu hỏi mẫu đã gán nhãn cho từng route, dùng để tính centroid embedding
+ROUTE_EXAMPLES = {
+    "guide": [
+        "How to register?",
+        "How to book a class?",
+        "How do I pay for my membership?",
+        "How can I reset my password?",
+        "Cách đăng ký tài khoản",
+        "Hướng dẫn đặt lịch",
+        "Làm sao để thanh toán",
+        "Làm thế nào để đăng ký lớp học",
+        "Cách hủy đăng ký lớp",
+        "Làm sao để đổi mật khẩu",
+    ],
+    "classes": [
+        "Show me the classes",
+        "What classes are available this week?",
+        "When is the yoga class?",
+        "Class schedule for tomorrow",
+        "Phòng gym có những lớp học nào?",
+        "Lịch học lớp yoga",
+        "Lớp boxing học vào thứ mấy?",
+        "Lịch các lớp học tuần này",
+        "Lớp nào còn chỗ trống?",
+        "Có lớp zumba buổi tối không?",
+    ],
+    "practice": [
+        "What exercises are good for losing weight?",
+        "Give me a workout for building muscle",
+        "How many sets of squats should I do?",
+        "Bài tập giảm mỡ bụng",
+        "Bài tập tăng cơ cho người mới",
+        "Nên tập bài gì cho chân?",
+        "Gợi ý bài tập cardio",
+        "Chế độ tập luyện cho người mới bắt đầu",
+        "Tập ngực như thế nào cho đúng?",
+    ],
+    "instructors": [
+        "Who are the trainers?",
+        "Tell me about the personal trainers",
+        "Which instructor teaches yoga?",
+        "Danh sách huấn luyện viên",
+        "Có PT nào kinh nghiệm không?",
+        "Huấn luyện viên dạy lớp yoga là ai?",
+        "Thông tin về các PT của phòng gym",
+        "Tôi muốn thuê huấn luyện viên cá nhân",
+    ],
+    "membership": [
+        "Tell me about membership",
+        "How much is the membership?",
+        "What plans do you have?",
+        "What does the VIP plan include?",
+        "Giá gói tập bao nhiêu?",
+        "Các gói tập của phòng gym",
+        "Gói VIP có những quyền lợi gì?",
+        "Bảng giá membership",
+        "Gói tập theo tháng giá bao nhiêu?",
+    ],
+    "gym_info": [
+        "What are the opening hours?",
+        "Where is the gym located?",
+        "How can I contact the gym?",
+        "Giờ mở cửa của phòng gym",
+        "Phòng gym ở đâu?",
+        "Địa chỉ phòng gym",
+        "Số điện thoại liên hệ",
+        "Phòng gym mở cửa lúc mấy giờ?",
+        "Phòng gym có bãi đỗ xe không?",
+    ],
+    "none": [
+        "What is the weather today?",
+        "Tell me a joke",
+        "Who won the football match?",
+        "Hôm nay thời tiết thế nào?",
+        "Kể cho tôi một câu chuyện cười",
+        "Giá vàng hôm nay",
+        "Viết giúp tôi một bài thơ",
+    ],
+}
+
+def _unit(vector):
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else list(vector)
+
+class RouteClassifier:
+    # Phân loại route bằng centroid gần nhất trên embedding MiniLM đã load sẵn.
+    # Chỉ tin kết quả khi độ tương đồng và khoảng cách với route thứ hai đủ lớn,
+    # ngược lại để model LLM quyết định.
+    def __init__(self, embeddings, examples=None, threshold=0.45, min_margin=0.05):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.min_margin = min_margin
+        self.centroids = {}
+
+        examples = examples or ROUTE_EXAMPLES
+        texts = [text for route in examples for text in examples[route]]
+        vectors = iter(embeddings.embed_documents(texts))
+        for route, route_examples in examples.items():
+            route_vectors = [_unit(next(vectors)) for _ in route_examples]
+            self.centroids[route] = _unit([sum(values) for values in zip(*route_vectors)])
+
+    def scores(self, query_embedding):
+        query_vector = _unit(query_embedding)
+        return {
+            route: sum(a * b for a, b in zip(query_vector, centroid))
+            for route, centroid in self.centroids.items()
+        }
+
+    def likely_route(self, query_embedding):
+        # Route gần nhất kể cả khi chưa đủ tự tin, dùng để chuẩn bị trước
+        scores = self.scores(query_embedding)
+        return max(scores, key=scores.get) if scores else None
+
+    def classify(self, query_embedding):
+        # Trả về (route, độ tương đồng, margin) hoặc route=None nếu không đủ tự tin
+        ranked = sorted(self.scores(query_embedding).items(), key=lambda item: item[1], reverse=True)
+        best_route, best_score = ranked[0]
+        margin = best_score - ranked[1][1] if len(ranked) > 1 else best_score
+        if best_score < self.threshold or margin < self.min_margin:
+            return None, best_score, margin
+        return best_route, best_score, margin
+
+def parse_route(text):
+    # Chuẩn hóa câu trả lời của LLM router về một route hợp lệ
+    text = text.strip().lower()
+    for route in ROUTES:
+        if route in text:
+            return route
+    return "none"
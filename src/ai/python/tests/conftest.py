@@ -0,0 +1,42 @@
+import hashlib
+import os
+import re
+import sys
+import pytest
+
+# Các module của service nằm phẳng trong src/ai/python
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class HashEmbeddings:
+    # Thay model HuggingFace trong test: vector đếm từ theo hash, cùng từ thì gần nhau
+    dimensions = 32
+
+    def embed_query(self, text):
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r'\w+', text.lower()):
+            vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % self.dimensions] += 1.0
+        return vector
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+@pytest.fixture
+def rag(tmp_path, monkeypatch):
+    # rag_service với index numpy, tài liệu và snapshot trong thư mục tạm
+    pytest.importorskip("dotenv")
+    pytest.importorskip("numpy")
+    pytest.importorskip("langchain")
+    import rag_service
+
+    documents = tmp_path / "documents"
+    crawled = documents / "crawled_data"
+    crawled.mkdir(parents=True)
+    monkeypatch.setattr(rag_service, "DB_PATH", str(tmp_path / "vector_db"))
+    monkeypatch.setattr(rag_service, "DOCUMENTS_DIR", str(documents))
+    monkeypatch.setattr(rag_service, "CRAWLED_DATA_DIR", str(crawled))
+    monkeypatch.setattr(rag_service, "VECTOR_BACKEND", "numpy")
+    monkeypatch.setattr(rag_service, "_embeddings_cache", HashEmbeddings())
+    monkeypatch.setattr(rag_service, "_vectorstore_cache", None)
+    monkeypatch.setattr(rag_service, "_vectorstore_version", None)
+    monkeypatch.setattr(rag_service, "_route_classifier_cache", None)
+    return rag_service
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+from context_builder import ContextBuilder
+
+def doc(text, **metadata):
+    return SimpleNamespace(page_content=text, metadata=metadata)
+
+def test_overlapping_chunks_of_same_source_are_merged():
+    builder = ContextBuilder(max_tokens=1000, chars_per_token=1)
+    first = "Gói VIP có giá 500.000đ mỗi tháng. Được tập không giới hạn"
+    second = "Được tập không giới hạn tại tất cả các chi nhánh FlexFit."
+    context, passages = builder.build([doc(first, source="a.txt"), doc(second, source="a.txt")])
+    assert passages == 1
+    assert context == "Gói VIP có giá 500.000đ mỗi tháng. Được tập không giới hạn tại tất cả các chi nhánh FlexFit."
+
+def test_same_text_from_other_source_is_dropped_and_rank_by_distance():
+    builder = ContextBuilder(max_tokens=1000, chars_per_token=1)
+    context, passages = builder.build([
+        doc("Lớp Yoga lúc 18h", source="classes.txt", distance=0.5),
+        doc("Lớp Yoga lúc 18h", source="guide.txt", distance=0.4),
+        doc("Lớp Boxing lúc 19h", source="classes.txt", distance=0.1),
+    ])
+    assert passages == 2
+    assert context == "Lớp Boxing lúc 19h\n\nLớp Yoga lúc 18h"
+
+def test_children_of_same_parent_use_parent_span():
+    builder = ContextBuilder(max_tokens=1000, chars_per_token=1)
+    parent = "VIP Plan:\n- Giá: 500.000₫\n- Tính năng:\n  + Tập không giới hạn\n  + Xông hơi miễn phí"
+    first = doc("- Giá: 500.000₫", source="m.txt", parent=parent, start=parent.index("- Giá"))
+    second = doc("+ Xông hơi miễn phí", source="m.txt", parent=parent, start=parent.index("+ Xông"))
+    context, passages = builder.build([first, second])
+    assert passages == 1
+    # Còn budget thì mở rộng ra cả parent
+    assert context == parent
+
+def test_budget_limits_context():
+    builder = ContextBuilder(max_tokens=20, chars_per_token=1)
+    long_text = "Huấn luyện viên Lan dạy Yoga và Pilates. " * 5
+    context, passages = builder.build([
+        doc(long_text, source="instructors.txt"),
+        doc("Nội dung khác không còn chỗ", source="guide.txt"),
+    ])
+    assert passages == 1
+    assert builder.count_tokens(context) <= 20
+    assert context.endswith("…")
+
+def test_expand_stays_within_budget_around_chunk():
+    builder = ContextBuilder(max_tokens=1000, chars_per_token=1)
+    parent = "\n".join(f"Dòng {i}: nội dung của dòng số {i}" for i in range(20))
+    start = parent.index("Dòng 10")
+    end = start + len("Dòng 10: nội dung của dòng số 10")
+    expanded = builder.expand(parent, start, end, 100)
+    assert "Dòng 10: nội dung của dòng số 10" in expanded
+    assert len(expanded) <= 100
+    assert expanded.startswith("Dòng ")
+
+def test_fit_history_truncates_long_answers():
+    builder = ContextBuilder(history_tokens=40, chars_per_token=1)
+    history = [
+        {"role": "user", "content": "Câu hỏi cũ bị bỏ"},
+        {"role": "user", "content": "Gói VIP giá bao nhiêu?"},
+        {"role": "assistant", "content": "Gói VIP giá 500.000đ. " * 10},
+    ]
+    fitted = builder.fit_history(history, max_messages=2)
+    assert [message["role"] for message in fitted] == ["user", "assistant"]
+    assert fitted[1]["content"].endswith("…")
+    assert sum(builder.count_tokens(message["content"]) for message in fitted) <= 40
@@ -0,0 +1,80 @@
+import os
+import threading
+
+def run_with_timeout(target, timeout=30):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", target()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "bị treo (deadlock giữa _index_build_lock và _vectorstore_lock?)"
+    return result.get("value")
+
+def write(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def test_first_refresh_builds_empty_index(rag):
+    # Chưa có snapshot nào: refresh_index phải tự build bản đầu tiên, không tự khóa chính nó
+    write(os.path.join(rag.CRAWLED_DATA_DIR, "membership.txt"),
+          "Gói Premium\n- Giá 500.000đ mỗi tháng, tập không giới hạn tất cả các chi nhánh FlexFit\n")
+    assert rag.index_snapshots().current_version() is None
+
+    run_with_timeout(lambda: rag.refresh_index([rag.crawled_file_path("membership")]))
+
+    version = rag.index_snapshots().current_version()
+    assert version is not None
+    assert rag._vectorstore_version == version
+    assert rag._index_build_lock.acquire(blocking=False)
+    rag._index_build_lock.release()
+
+def test_refresh_publishes_new_snapshot(rag):
+    source = rag.crawled_file_path("classes")
+    write(source, "Lớp Yoga\n- Thứ 2, 4, 6 lúc 18h với huấn luyện viên Lan, phù hợp người mới bắt đầu\n")
+    first = run_with_timeout(rag.load_documents)
+    assert first is not None
+    old_version = rag._vectorstore_version
+
+    write(source, "Lớp Yoga\n- Thứ 3, 5, 7 lúc 19h với huấn luyện viên Lan, phù hợp người mới bắt đầu\n")
+    changed = run_with_timeout(lambda: rag.refresh_index([source]))
+
+    assert changed == {source}
+    assert rag._vectorstore_version != old_version
+    assert rag.index_snapshots().current_version() == rag._vectorstore_version
+
+def test_concurrent_load_and_first_refresh(rag):
+    # Request đầu tiên và refresh nền cùng lúc trên index rỗng: cả hai phải xong
+    write(os.path.join(rag.DOCUMENTS_DIR, "gym_info.txt"),
+          "FlexFit mở cửa từ 5h sáng tới 22h tất cả các ngày trong tuần, kể cả ngày lễ và cuối tuần\n")
+    threads = [threading.Thread(target=rag.load_documents, daemon=True) for _ in range(4)]
+    threads.append(threading.Thread(target=rag.refresh_index, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+        assert not thread.is_alive()
+    assert len(rag.index_snapshots().versions()) == 1
+    assert rag.load_documents() is not None
+
+def test_replaced_snapshots_are_closed_before_cleanup(rag, monkeypatch):
+    # Vector store của snapshot cũ phải được đóng trước khi cleanup xóa thư mục của nó
+    monkeypatch.setattr(rag, "INDEX_RETENTION", 2)
+    monkeypatch.setattr(rag, "_retired_vectorstores", rag.OrderedDict())
+    closed = []
+    monkeypatch.setattr(rag, "close_vectorstore", lambda vectorstore: closed.append(vectorstore))
+    source = rag.crawled_file_path("practice")
+    stores = []
+    for day in range(4):
+        write(source, f"Bài tập ngày {day}\n- Squat 4 hiệp 12 lần, nghỉ 90 giây giữa các hiệp, tăng tạ dần\n")
+        run_with_timeout(lambda: rag.refresh_index([source]))
+        stores.append(rag._vectorstore_cache)
+
+    assert len(rag.index_snapshots().versions()) == 2
+    assert stores[0] in closed and stores[1] in closed
+    assert stores[3] not in closed
+    assert set(rag._retired_vectorstores) <= set(rag.index_snapshots().versions())
+
+def test_route_from_source_matches_route_in_file_name(rag):
+    assert rag.route_from_source(rag.crawled_file_path("membership")) == "membership"
+    assert rag.route_from_source("documents/membership_plans.txt") == "membership"
+    assert rag.route_from_source("documents/Guide-FlexFit.txt") == "guide"
+    assert rag.route_from_source("documents/faq.txt") == "faq"
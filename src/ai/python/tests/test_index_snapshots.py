@@ -0,0 +1,76 @@
+import os
+import index_snapshots
+from index_snapshots import SnapshotStore
+
+def make(store, base=None, content=None):
+    version = store.create(base)
+    if content is not None:
+        with open(os.path.join(store.path(version), "data.txt"), 'w', encoding='utf-8') as f:
+            f.write(content)
+    return version
+
+def test_publish_switches_current(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    assert store.current_version() is None
+    first = make(store, content="v1")
+    # Chưa publish thì chưa phục vụ
+    assert store.current_version() is None
+    store.publish(first)
+    assert store.current_version() == first
+    assert not os.path.exists(os.path.join(str(tmp_path), "CURRENT.tmp"))
+
+    second = make(store, base=first)
+    with open(os.path.join(store.path(second), "data.txt"), encoding='utf-8') as f:
+        assert f.read() == "v1"
+    store.publish(second)
+    assert store.current_version() == second
+    assert store.versions() == [first, second]
+
+def test_current_pointing_to_missing_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    version = make(store)
+    store.publish(version)
+    store.discard(version)
+    assert store.current_version() is None
+
+def test_cleanup_keeps_retention_and_builds_in_progress(tmp_path):
+    store = SnapshotStore(str(tmp_path), retention=2)
+    published = []
+    for i in range(4):
+        published.append(make(store, content=str(i)))
+        store.publish(published[-1])
+    building = make(store)
+    released = []
+
+    store.cleanup(release=released.append)
+
+    assert released == published[:2]
+    assert store.versions() == published[2:] + [building]
+    assert store.current_version() == published[-1]
+
+def test_cleanup_removes_stale_builds(tmp_path):
+    store = SnapshotStore(str(tmp_path), retention=1)
+    current = make(store)
+    store.publish(current)
+    abandoned = make(store)
+    old = os.path.getmtime(store.path(abandoned)) - SnapshotStore.STALE_BUILD_SECONDS - 10
+    os.utime(store.path(abandoned), (old, old))
+
+    store.cleanup()
+    assert store.versions() == [current]
+
+def test_cleanup_logs_error_when_delete_fails(tmp_path, monkeypatch):
+    store = SnapshotStore(str(tmp_path), retention=1)
+    versions = [make(store) for _ in range(2)]
+    store.publish(versions[-1])
+    errors = []
+
+    def rmtree(path):
+        raise PermissionError(f"đang được mở: {path}")
+
+    monkeypatch.setattr(index_snapshots.shutil, "rmtree", rmtree)
+    monkeypatch.setattr(index_snapshots.logger, "error", errors.append)
+    store.cleanup()
+
+    assert len(errors) == 1 and versions[0] in errors[0]
+    assert store.versions() == versions
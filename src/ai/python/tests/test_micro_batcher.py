@@ -0,0 +1,79 @@
+import asyncio
+import threading
+from micro_batcher import MicroBatcher
+
+def test_cancelled_call_does_not_fail_batch():
+    # Một lời gọi bị hủy khi đang chờ không được làm hỏng các lời gọi khác cùng batch
+    release = threading.Event()
+    calls = []
+
+    def double(items):
+        calls.append(list(items))
+        release.wait(5)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, max_batch=8, max_wait=0.05, name="test")
+    first = batcher.enqueue(1)
+    # batch đầu đang chạy, các lời gọi sau chờ batch kế tiếp
+    while not calls:
+        threading.Event().wait(0.001)
+    waiting = [batcher.enqueue(value) for value in (2, 3, 4)]
+    assert waiting[1].cancel()
+    release.set()
+
+    assert first.result(5) == 2
+    assert waiting[0].result(5) == 4
+    assert waiting[2].result(5) == 8
+    assert waiting[1].cancelled()
+    assert calls[1] == [2, 4]
+
+def test_cancel_through_wrap_future():
+    # Request async bị hủy (asyncio.wrap_future hủy luôn future của batcher)
+    release = threading.Event()
+    batcher = MicroBatcher(lambda items: release.wait(5) and [item + 1 for item in items],
+                           max_batch=8, max_wait=0.02, name="test")
+
+    async def main():
+        blocker = asyncio.wrap_future(batcher.enqueue(0))
+        await asyncio.sleep(0.05)
+        cancelled = asyncio.ensure_future(asyncio.wrap_future(batcher.enqueue(10)))
+        kept = asyncio.wrap_future(batcher.enqueue(20))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        release.set()
+        return await blocker, await kept, await asyncio.gather(cancelled, return_exceptions=True)
+
+    blocker, kept, (cancelled,) = asyncio.run(main())
+    assert (blocker, kept) == (1, 21)
+    assert isinstance(cancelled, asyncio.CancelledError)
+
+def test_calls_are_batched_in_order():
+    calls = []
+
+    def upper(items):
+        calls.append(list(items))
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(upper, max_batch=3, max_wait=0.2, name="test")
+    futures = [batcher.enqueue(text) for text in "abcde"]
+    assert [future.result(5) for future in futures] == list("ABCDE")
+    assert calls == [["a", "b", "c"], ["d", "e"]]
+
+def test_fn_error_fails_whole_batch_only():
+    def fail_on_x(items):
+        if "x" in items:
+            raise RuntimeError("hỏng")
+        return items
+
+    batcher = MicroBatcher(fail_on_x, max_batch=2, max_wait=0.2, name="test")
+    bad = [batcher.enqueue("x"), batcher.enqueue("y")]
+    good = batcher.enqueue("z")
+    for future in bad:
+        assert isinstance(future.exception(5), RuntimeError)
+    assert good.result(5) == "z"
+
+def test_wrong_result_count_is_an_error():
+    batcher = MicroBatcher(lambda items: items[:1], max_batch=2, max_wait=0.2, name="test")
+    futures = [batcher.enqueue(1), batcher.enqueue(2)]
+    for future in futures:
+        assert isinstance(future.exception(5), ValueError)
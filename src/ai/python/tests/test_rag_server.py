@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace as NS
+import pytest
+
+class StubStream:
+    # Stream của openai: từng chunk có delta.content, chunk cuối có finish_reason
+    def __init__(self, words, delay):
+        self.words = words
+        self.delay = delay
+        self.sent = 0
+        self.closed = False
+
+    async def __aiter__(self):
+        for i, word in enumerate(self.words):
+            await asyncio.sleep(self.delay)
+            self.sent += 1
+            finish_reason = "stop" if i == len(self.words) - 1 else None
+            yield NS(choices=[NS(delta=NS(content=word), finish_reason=finish_reason)])
+
+    async def close(self):
+        self.closed = True
+
+class StubCompletions:
+    # gemma2:9b (router) luôn trả "membership", gemma2:2b trả lời cố định
+    def __init__(self, words=("Gói ", "VIP ", "giá ", "500.000₫"), delay=0):
+        self.words = list(words)
+        self.delay = delay
+        self.calls = []
+        self.streams = []
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        self.calls.append({"model": model, "stream": stream, **kwargs})
+        if model == "gemma2:9b":
+            return NS(choices=[NS(message=NS(content="membership"))])
+        if stream:
+            self.streams.append(StubStream(self.words, self.delay))
+            return self.streams[-1]
+        return NS(choices=[NS(message=NS(content="".join(self.words)), finish_reason="stop")])
+
+class Stdin:
+    # stdin của server: trả từng dòng sau khoảng chờ (giây) tương ứng, hết thì EOF
+    def __init__(self, lines):
+        self.lines = list(lines)
+
+    def readline(self):
+        if not self.lines:
+            return ""
+        delay, line = self.lines.pop(0)
+        time.sleep(delay)
+        return json.dumps(line) + "\n"
+
+def write(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+@pytest.fixture
+def server(rag, monkeypatch):
+    from answer_cache import AnswerCache
+    write(os.path.join(rag.CRAWLED_DATA_DIR, "membership.txt"),
+          "VIP Plan:\n- Giá: 500.000₫\n- Tính năng:\n  + Tập không giới hạn tất cả chi nhánh\n")
+    write(os.path.join(rag.CRAWLED_DATA_DIR, "classes.txt"),
+          "Yoga:\n- Thứ 2, 4, 6 lúc 18h với huấn luyện viên Lan\n")
+    completions = StubCompletions()
+    events = []
+    monkeypatch.setattr(rag, "get_ai_client", lambda: NS(chat=NS(completions=completions)))
+    monkeypatch.setattr(rag, "get_route_classifier", lambda: None)
+    monkeypatch.setattr(rag, "emit_stdout", events.append)
+    monkeypatch.setattr(rag, "answer_cache", AnswerCache(max_size=16))
+    monkeypatch.setattr(rag, "CRAWL_ROUTES", [])
+    monkeypatch.setattr(rag, "STREAM_FRAME_CHARS", 0)
+    monkeypatch.setattr(rag, "_embed_batcher", None)
+    monkeypatch.setattr(rag, "_search_batcher", None)
+
+    def run(lines):
+        monkeypatch.setattr(sys, "stdin", Stdin(lines))
+        asyncio.run(rag.serve())
+        return events
+
+    return NS(rag=rag, completions=completions, run=run)
+
+def by_id(events, request_id):
+    return [event for event in events if event.get("id") == request_id]
+
+def test_requests_are_tagged_and_end_with_done(server):
+    events = server.run([
+        (0, {"id": "a", "query": "Gói VIP giá bao nhiêu?", "stream": True}),
+        (0, {"id": "b", "query": "Lớp yoga học lúc mấy giờ?", "stream": False}),
+        (0.3, {"id": "m", "op": "metrics"}),
+    ])
+
+    assert events[0] == {"type": "ready"}
+    streamed = by_id(events, "a")
+    assert streamed[0]["type"] == "context" and "VIP Plan" in streamed[0]["content"]
+    # STREAM_FRAME_CHARS=0: mỗi token một event
+    assert [event["content"] for event in streamed if event["type"] == "token"] == ["Gói ", "VIP ", "giá ", "500.000₫"]
+    assert streamed[-1] == {"id": "a", "type": "done"}
+
+    result = by_id(events, "b")
+    assert [event["type"] for event in result] == ["result", "done"]
+    assert result[0]["response"] == "Gói VIP giá 500.000₫"
+
+    assert by_id(events, "m")[0]["type"] == "metrics"
+    assert "rag_requests_total" in by_id(events, "m")[0]["content"]
+    assert all(sum(event["type"] == "done" for event in by_id(events, request_id)) == 1
+               for request_id in ("a", "b", "m"))
+
+def test_tokens_are_coalesced_into_frames(server, monkeypatch):
+    monkeypatch.setattr(server.rag, "STREAM_FRAME_CHARS", 48)
+    monkeypatch.setattr(server.rag, "STREAM_FRAME_MS", 10000)
+    events = server.run([(0, {"id": "a", "query": "Gói VIP giá bao nhiêu?", "stream": True})])
+    tokens = [event["content"] for event in by_id(events, "a") if event["type"] == "token"]
+    assert tokens == ["Gói VIP giá 500.000₫"]
+
+def test_cancel_stops_generation(server):
+    server.completions.words = [f"w{i} " for i in range(100)]
+    server.completions.delay = 0.02
+    events = server.run([
+        (0, {"id": "a", "query": "Gói VIP giá bao nhiêu?", "stream": True}),
+        (0.5, {"op": "cancel", "id": "a"}),
+    ])
+
+    stream = server.completions.streams[0]
+    assert stream.closed
+    assert stream.sent < 100
+    assert by_id(events, "a")[-1] == {"id": "a", "type": "done"}
+    assert not any(event["type"] == "error" for event in by_id(events, "a"))
+
+def test_generation_uses_route_budget_and_stop(server):
+    server.run([(0, {"id": "a", "query": "Gói VIP giá bao nhiêu?", "stream": True})])
+    answer = [call for call in server.completions.calls if call["model"] == "gemma2:2b"][0]
+    assert answer["max_tokens"] == server.rag.ROUTE_MAX_TOKENS["membership"]
+    assert answer["stop"] == server.rag.GENERATION_STOP
+
+def test_speculative_embedding_reused_for_cache_lookup(server, monkeypatch):
+    # Không có router cục bộ: câu hỏi chỉ được embed một lần (trong lúc tìm song song)
+    rag = server.rag
+    embedded = []
+    aembed_query = rag.aembed_query
+
+    async def counting(query):
+        embedded.append(query)
+        return await aembed_query(query)
+
+    monkeypatch.setattr(rag, "aembed_query", counting)
+    result = json.loads(asyncio.run(rag.aget_response("Gói VIP giá bao nhiêu?")))
+    assert result["response"] == "Gói VIP giá 500.000₫"
+    assert embedded == ["Gói VIP giá bao nhiêu?"]
+
+def test_inline_crawl_answers_from_new_snapshot(server, monkeypatch):
+    # Không có scheduler: request tự crawl route thiếu dữ liệu rồi phải tìm trong snapshot vừa publish
+    rag = server.rag
+    membership = rag.crawled_file_path("membership")
+    with open(membership, encoding='utf-8') as f:
+        content = f.read()
+    os.remove(membership)
+    monkeypatch.setattr(rag, "_refresh_scheduler", None)
+    monkeypatch.setattr(rag, "crawl_website", lambda route: write(membership, content) or True)
+
+    result = json.loads(asyncio.run(rag.aget_response("Gói VIP giá bao nhiêu?")))
+    assert "VIP Plan" in result["context"]
+    assert "Yoga" not in result["context"]
@@ -0,0 +1,154 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("requests")
+pytest.importorskip("dotenv")
+import web_crawler
+from web_crawler import WebCrawler
+
+MEMBERSHIP_PAGE = """<html><body>
+<nav><a href="/">Trang chủ</a></nav>
+<h2>Giờ mở cửa</h2>
+<div><p>Thứ 2 - Chủ nhật: 5h - 22h</p></div>
+<div class="plans">
+  <div class="plan">
+    <h3>VIP Plan</h3>
+    <p>500.000₫ / tháng</p>
+    <ul>
+      <li>Tập không giới hạn</li>
+      <li>Tập không giới hạn</li>
+      <li><div>Huấn luyện viên riêng</div></li>
+    </ul>
+    <button>Get Started now</button>
+  </div>
+</div>
+<script>window.config = {"Plan": "không phải nội dung"}</script>
+</body></html>"""
+
+SPA_PAGE = """<html><body><div id="root"></div><script src="/app.js"></script></body></html>"""
+LOADING_PAGE = """<html><body><div id="root"><div>Đang tải...</div></div><script src="/app.js"></script></body></html>"""
+
+class Site:
+    # Frontend giả: trang tĩnh có ETag, trả 304 khi If-None-Match khớp
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.requests.append((self.path, self.headers.get('If-None-Match')))
+                if self.path not in site.pages:
+                    self.send_error(404)
+                    return
+                body, etag = site.pages[self.path]
+                if etag and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                if etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def site():
+    site = Site({
+        "/membership": (MEMBERSHIP_PAGE, '"v1"'),
+        "/classes": (SPA_PAGE, None),
+        "/instructors": (LOADING_PAGE, None),
+    })
+    yield site
+    site.close()
+
+@pytest.fixture
+def crawler(site, tmp_path, monkeypatch):
+    monkeypatch.setattr(web_crawler, "CRAWL_STATIC_FIRST", True)
+    crawler = WebCrawler(frontend_url=site.url, pool_size=1)
+    crawler.crawled_data_dir = str(tmp_path)
+    yield crawler
+    crawler.close()
+
+def test_extract_records_dedups_and_skips_noise():
+    records = WebCrawler(frontend_url="http://localhost").extract_records(MEMBERSHIP_PAGE)
+    assert records == [
+        {"type": "section", "title": "Giờ mở cửa", "items": ["Thứ 2 - Chủ nhật: 5h - 22h"]},
+        {"type": "plan", "name": "VIP Plan", "price": "500.000₫ / tháng",
+         "features": ["Tập không giới hạn", "Huấn luyện viên riêng"]},
+    ]
+
+def test_static_page_skips_browser(crawler, monkeypatch, tmp_path):
+    monkeypatch.setattr(crawler, "fetch_rendered", lambda url: pytest.fail("không được mở browser"))
+    assert crawler.crawl_route("membership")
+    content = (tmp_path / "membership.txt").read_text(encoding='utf-8')
+    assert "VIP Plan:\n- Giá: 500.000₫ / tháng" in content
+    assert content.count("Tập không giới hạn") == 1
+    assert (tmp_path / "membership.json").exists()
+
+def test_unchanged_page_returns_304(crawler, site, monkeypatch, tmp_path):
+    monkeypatch.setattr(crawler, "fetch_rendered", lambda url: pytest.fail("không được mở browser"))
+    assert crawler.crawl_route("membership")
+    saved = tmp_path / "membership.txt"
+    saved.write_text("đã sửa tay", encoding='utf-8')
+
+    assert crawler.fetch_static(site.url + "/membership") is None
+    assert crawler.crawl_route("membership")
+    assert site.requests[-1] == ("/membership", '"v1"')
+    # 304 thì không ghi lại file
+    assert saved.read_text(encoding='utf-8') == "đã sửa tay"
+
+def test_changed_etag_crawls_again(crawler, site, tmp_path):
+    assert crawler.crawl_route("membership")
+    site.pages["/membership"] = (MEMBERSHIP_PAGE.replace("500.000₫", "450.000₫"), '"v2"')
+    assert crawler.crawl_route("membership")
+    assert "450.000₫" in (tmp_path / "membership.txt").read_text(encoding='utf-8')
+    assert crawler.etags[site.url + "/membership"] == '"v2"'
+
+def test_spa_page_falls_back_to_browser(crawler, monkeypatch, tmp_path):
+    rendered = []
+
+    def fetch_rendered(url):
+        rendered.append(url)
+        return [{"type": "section", "title": "Yoga", "items": ["Thứ 2, 4, 6 lúc 18h"]}]
+
+    monkeypatch.setattr(crawler, "fetch_rendered", fetch_rendered)
+    assert crawler.crawl_route("classes")
+    assert rendered == [crawler.frontend_url + "/classes"]
+    assert (tmp_path / "classes.txt").read_text(encoding='utf-8') == "Yoga:\n- Thứ 2, 4, 6 lúc 18h"
+
+def test_spa_placeholder_is_not_taken_as_content(crawler, monkeypatch, tmp_path):
+    # Khung SPA có chữ "Đang tải..." vẫn phải render bằng browser, không lưu placeholder
+    monkeypatch.setattr(crawler, "fetch_rendered",
+                        lambda url: [{"type": "section", "title": "Huấn luyện viên", "items": ["Lan - Yoga"]}])
+    assert crawler.crawl_route("instructors")
+    assert "Đang tải" not in (tmp_path / "instructors.txt").read_text(encoding='utf-8')
+
+def test_ready_selector_decides_static_page(crawler, site, monkeypatch):
+    monkeypatch.setattr(web_crawler, "CRAWL_READY_SELECTOR", ".plan")
+    assert crawler.fetch_static(site.url + "/membership")
+    crawler.etags.clear()
+    monkeypatch.setattr(web_crawler, "CRAWL_READY_SELECTOR", ".schedule")
+    assert crawler.fetch_static(site.url + "/membership") == []
+
+def test_inline_markup_does_not_split_words():
+    page = "<html><body><h2>Bảng <i>giá</i> vé</h2><p>Gi<b>á</b> vé ngày: 50.000<span>₫</span>\n  mỗi   lượt</p></body></html>"
+    records = WebCrawler(frontend_url="http://localhost").extract_records(page)
+    assert records == [{"type": "section", "title": "Bảng giá vé", "items": ["Giá vé ngày: 50.000₫ mỗi lượt"]}]
@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import threading
+import time
+import pytest
+from worker_pool import WorkerPool
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="chế độ pre-fork cần os.fork")
+
+def holding_worker(index):
+    # Worker giả: nhận request rồi giữ tới khi bị hủy hoặc stdin đóng
+    def emit(event):
+        sys.stdout.write(json.dumps(event) + "\n")
+        sys.stdout.flush()
+
+    held = []
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request.get("op") == "cancel":
+            if request["id"] in held:
+                held.remove(request["id"])
+                emit({"id": request["id"], "type": "cancelled", "worker": index})
+                emit({"id": request["id"], "type": "done"})
+            continue
+        held.append(request["id"])
+        emit({"id": request["id"], "type": "accepted", "worker": index})
+    for request_id in held:
+        emit({"id": request_id, "type": "done"})
+
+class Events:
+    def __init__(self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.items.append(event)
+
+    def of(self, request_id, event_type=None):
+        with self.lock:
+            return [event for event in self.items
+                    if event.get("id") == request_id and event_type in (None, event["type"])]
+
+    def wait(self, request_id, event_type, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            found = self.of(request_id, event_type)
+            if found:
+                return found[0]
+            time.sleep(0.01)
+        raise AssertionError(f"không nhận được {event_type} của {request_id}")
+
+@pytest.fixture
+def pool():
+    events = Events()
+    pool = WorkerPool(2, holding_worker, events, capacity=2, max_queue=1)
+    pool.start()
+    yield pool, events
+    if not pool.stopping:
+        pool.stop()
+
+def test_conversation_sticks_to_its_worker(pool):
+    pool, events = pool
+    pool.submit({"id": "a", "conversation_id": "c1"})
+    assert events.wait("a", "accepted")["worker"] == 0
+    pool.submit({"id": "b", "conversation_id": "c2"})
+    assert events.wait("b", "accepted")["worker"] == 1
+    pool.submit({"id": "d"})
+    assert events.wait("d", "accepted")["worker"] == 0
+
+    # Worker 0 đã đầy: request của c1 chờ worker 0 dù worker 1 còn chỗ
+    pool.submit({"id": "c", "conversation_id": "c1"})
+    time.sleep(0.2)
+    assert not events.of("c")
+
+    pool.cancel("d")
+    assert events.wait("d", "cancelled")["worker"] == 0
+    assert events.wait("c", "accepted")["worker"] == 0
+
+def test_cancel_queued_request_and_reject_when_full(pool):
+    pool, events = pool
+    for request_id in ("a", "b", "c", "d"):
+        pool.submit({"id": request_id})
+    pool.submit({"id": "queued"})
+    pool.submit({"id": "rejected"})
+    assert events.wait("rejected", "error")["content"].startswith("System Error")
+
+    pool.cancel("queued")
+    events.wait("queued", "done")
+    assert not events.of("queued", "accepted")
+    assert not events.of("queued", "cancelled")
+
+def test_stop_finishes_every_request(pool):
+    pool, events = pool
+    for request_id in ("a", "b", "c"):
+        pool.submit({"id": request_id})
+    for request_id in ("a", "b", "c"):
+        events.wait(request_id, "accepted")
+    pool.stop()
+    for request_id in ("a", "b", "c"):
+        assert len(events.of(request_id, "done")) == 1
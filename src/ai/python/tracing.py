@@ -0,0 +1,175 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Mặc định chỉ ghi cảnh báo/lỗi; RAG_LOG_LEVEL=INFO hoặc DEBUG khi cần xem chi tiết
+LOG_LEVEL = os.getenv('RAG_LOG_LEVEL', 'WARNING').upper()
+# Ghi mỗi request một dòng JSON chứa thời gian từng bước (để trống = không ghi file)
+METRICS_FILE = os.getenv('RAG_METRICS_FILE', '')
+
+# Các mốc thời gian (ms) của histogram Prometheus
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+_configured = False
+_configure_lock = threading.Lock()
+
+def get_logger(name):
+    # Mọi log đều ra stderr (stdout dành cho event JSON) kèm id của request đang xử lý
+    global _configured
+    with _configure_lock:
+        if not _configured:
+            handler = logging.StreamHandler(sys.stderr)
+            handler.addFilter(RequestIdFilter())
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+            ))
+            root = logging.getLogger('rag')
+            root.addHandler(handler)
+            root.setLevel(getattr(logging, LOG_LEVEL, logging.WARNING))
+            root.propagate = False
+            _configured = True
+    return logging.getLogger(name)
+
+class MetricsRegistry:
+    # Gom thời gian các bước của mọi request để xuất theo định dạng Prometheus
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, value_ms):
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                stage, {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0}
+            )
+            histogram["count"] += 1
+            histogram["sum"] += value_ms
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value_ms <= bound:
+                    histogram["buckets"][i] += 1
+
+    def increment(self, name, labels=None, amount=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self):
+        # Dạng JSON được để gửi giữa các process (chế độ pre-fork)
+        with self.lock:
+            return {
+                "histograms": {stage: dict(histogram, buckets=list(histogram["buckets"]))
+                               for stage, histogram in self.histograms.items()},
+                "counters": [[name, dict(labels), value] for (name, labels), value in self.counters.items()]
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for stage, other in snapshot.get("histograms", {}).items():
+                histogram = self.histograms.setdefault(
+                    stage, {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0}
+                )
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+        for name, labels, value in snapshot.get("counters", []):
+            self.increment(name, labels, amount=value)
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            if self.histograms:
+                lines.append("# TYPE rag_stage_latency_ms histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                    lines.append(f'rag_stage_latency_ms_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'rag_stage_latency_ms_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'rag_stage_latency_ms_sum{{stage="{stage}"}} {histogram["sum"]:.3f}')
+                lines.append(f'rag_stage_latency_ms_count{{stage="{stage}"}} {histogram["count"]}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name != name:
+                        continue
+                    label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+                    lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+_metrics_file_lock = threading.Lock()
+
+class Trace:
+    # Đo thời gian từng bước của một request: routing, retrieval, crawl,
+    # prompt_build, ttft (tới token đầu tiên), generation và total
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.fields = {}
+        self.finished = False
+        self.token = request_id_var.set(self.request_id)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def record(self, name, started):
+        # Cộng thời gian từ started (time.perf_counter()) tới hiện tại vào bước name
+        self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def mark(self, name):
+        # Mốc tính từ đầu request (vd: ttft), chỉ ghi lần đầu
+        self.timings.setdefault(name, self.elapsed_ms())
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def finish(self, **fields):
+        if self.finished:
+            return
+        self.finished = True
+        self.fields.update(fields)
+        self.timings["total"] = self.elapsed_ms()
+
+        for stage, value_ms in self.timings.items():
+            metrics.observe(stage, value_ms)
+        metrics.increment("rag_requests_total", {
+            "route": self.fields.get("route", "unknown"),
+            "status": self.fields.get("status", "ok"),
+        })
+
+        record = {
+            "request_id": self.request_id,
+            "timestamp": time.time(),
+            "timings_ms": {stage: round(value, 2) for stage, value in self.timings.items()},
+            **self.fields,
+        }
+        get_logger('rag.trace').info(json.dumps(record, ensure_ascii=False))
+        if METRICS_FILE:
+            with _metrics_file_lock, open(METRICS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        try:
+            request_id_var.reset(self.token)
+        except ValueError:
+            # finish() được gọi ở context khác với lúc tạo trace
+            pass
+        return record
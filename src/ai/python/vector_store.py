@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import numpy as np
+from langchain.schema import Document
+from tracing import get_logger
+
+logger = get_logger('rag.vector_store')
+
+class NumpyVectorStore:
+    # Vector store trong process cho corpus nhỏ: ma trận float32 liên tục, mỗi dòng
+    # đã chuẩn hóa nên cosine chỉ là một phép nhân ma trận. Lưu ra disk dạng .npy
+    # và load lại bằng memmap. Cung cấp các hàm của Chroma mà rag_service dùng tới.
+    VECTORS_FILE = "vectors.npy"
+    DOCUMENTS_FILE = "documents.json"
+
+    def __init__(self, persist_directory, embedding_function):
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.lock = threading.Lock()
+        # (ids, texts, metadatas, matrix, masks), thay cả bộ khi thêm/xóa để các request
+        # đang tìm kiếm luôn đọc được một trạng thái nhất quán
+        self.state = self._make_state([], [], [], np.zeros((0, 0), dtype=np.float32))
+        self._load()
+
+    @classmethod
+    def exists(cls, persist_directory):
+        return os.path.exists(os.path.join(persist_directory, cls.DOCUMENTS_FILE))
+
+    def _path(self, name):
+        return os.path.join(self.persist_directory, name)
+
+    def _load(self):
+        if not self.exists(self.persist_directory):
+            return
+        try:
+            with open(self._path(self.DOCUMENTS_FILE), encoding='utf-8') as f:
+                data = json.load(f)
+            matrix = np.load(self._path(self.VECTORS_FILE), mmap_mode='r')
+            if matrix.shape[0] != len(data["ids"]):
+                raise ValueError(f"{matrix.shape[0]} vector nhưng {len(data['ids'])} chunk")
+            self.state = self._make_state(data["ids"], data["texts"], data["metadatas"], matrix)
+        except Exception as e:
+            # Index hỏng thì bắt đầu lại từ rỗng, sync_index sẽ index lại toàn bộ
+            logger.error(f"Không đọc được index {self.persist_directory}: {str(e)}")
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    @staticmethod
+    def _make_state(ids, texts, metadatas, matrix):
+        return ids, texts, metadatas, matrix, {}
+
+    @staticmethod
+    def _mask(state, search_filter):
+        # Mask của filter {key: value} được tính một lần cho mỗi trạng thái
+        if not search_filter:
+            return None
+        key = tuple(sorted(search_filter.items()))
+        masks = state[4]
+        if key not in masks:
+            masks[key] = np.array([
+                all(metadata.get(field) == value for field, value in search_filter.items())
+                for metadata in state[2]
+            ], dtype=bool)
+        return masks[key]
+
+    def get(self, ids=None, where=None, include=None):
+        all_ids, texts, metadatas = self.state[:3]
+        rows = range(len(all_ids))
+        if ids is not None:
+            wanted = set(ids)
+            rows = [row for row in rows if all_ids[row] in wanted]
+        if where:
+            rows = [row for row in rows if all(metadatas[row].get(k) == v for k, v in where.items())]
+        return {
+            "ids": [all_ids[row] for row in rows],
+            "metadatas": [metadatas[row] for row in rows],
+            "documents": [texts[row] for row in rows],
+        }
+
+    def add_documents(self, documents, ids):
+        vectors = self._normalize(self.embedding_function.embed_documents([doc.page_content for doc in documents]))
+        replaced = set(ids)
+        with self.lock:
+            old_ids, texts, metadatas, matrix = self.state[:4]
+            keep = [row for row, chunk_id in enumerate(old_ids) if chunk_id not in replaced]
+            base = np.asarray(matrix[keep]) if len(old_ids) else np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            self.state = self._make_state(
+                [old_ids[row] for row in keep] + list(ids),
+                [texts[row] for row in keep] + [doc.page_content for doc in documents],
+                [metadatas[row] for row in keep] + [dict(doc.metadata) for doc in documents],
+                np.ascontiguousarray(np.vstack([base, vectors]), dtype=np.float32),
+            )
+        return list(ids)
+
+    def delete(self, ids):
+        removed = set(ids)
+        with self.lock:
+            old_ids, texts, metadatas, matrix = self.state[:4]
+            keep = [row for row, chunk_id in enumerate(old_ids) if chunk_id not in removed]
+            self.state = self._make_state(
+                [old_ids[row] for row in keep],
+                [texts[row] for row in keep],
+                [metadatas[row] for row in keep],
+                np.ascontiguousarray(matrix[keep], dtype=np.float32),
+            )
+
+    def persist(self):
+        # Ghi ra file tạm rồi đổi tên để tiến trình khác không đọc phải file ghi dở
+        os.makedirs(self.persist_directory, exist_ok=True)
+        with self.lock:
+            ids, texts, metadatas, matrix = self.state[:4]
+            vectors_tmp = self._path(self.VECTORS_FILE + ".tmp")
+            with open(vectors_tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+            documents_tmp = self._path(self.DOCUMENTS_FILE + ".tmp")
+            with open(documents_tmp, 'w', encoding='utf-8') as f:
+                json.dump({"ids": ids, "texts": texts, "metadatas": metadatas}, f, ensure_ascii=False)
+            # Trên Windows không thay được file đang được memmap
+            if isinstance(matrix, np.memmap):
+                self.state = self._make_state(ids, texts, metadatas, np.array(matrix))
+            os.replace(vectors_tmp, self._path(self.VECTORS_FILE))
+            os.replace(documents_tmp, self._path(self.DOCUMENTS_FILE))
+
+    def close(self):
+        # Bỏ memmap của snapshot cũ để file được đóng (Windows không xóa được file đang map);
+        # request còn giữ trạng thái cũ vẫn đọc tiếp được tới khi xong
+        with self.lock:
+            self.state = self._make_state([], [], [], np.zeros((0, 0), dtype=np.float32))
+
+    def _top_k(self, state, scores, k, search_filter):
+        # Trả về (các dòng, điểm cosine) của tối đa k dòng tốt nhất, điểm giảm dần
+        rows = np.arange(len(scores))
+        mask = self._mask(state, search_filter)
+        if mask is not None:
+            rows = rows[mask]
+            scores = scores[mask]
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return rows[order], scores[order]
+
+    def _candidates(self, embedding, k, search_filter):
+        state = self.state
+        if not len(state[0]):
+            return state, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows, scores = self._top_k(state, state[3] @ self._normalize(embedding), k, search_filter)
+        return state, rows, scores
+
+    def batch_similarity_search_by_vectors_with_relevance_scores(self, embeddings, ks, filters):
+        # Nhiều câu hỏi cùng lúc: một phép nhân ma trận cho cả batch rồi lấy top-k từng câu
+        state = self.state
+        if not len(state[0]):
+            return [[] for _ in embeddings]
+        all_scores = self._normalize(embeddings) @ state[3].T
+        results = []
+        for scores, k, search_filter in zip(all_scores, ks, filters):
+            rows, top_scores = self._top_k(state, scores, k, search_filter)
+            results.append([(self._document(state, row), float(1 - score)) for row, score in zip(rows, top_scores)])
+        return results
+
+    def _document(self, state, row):
+        return Document(page_content=state[1][row], metadata=dict(state[2][row]))
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, **kwargs):
+        # Giống Chroma: giá trị đi kèm là khoảng cách (cosine distance), càng nhỏ càng gần
+        state, rows, scores = self._candidates(embedding, k, filter)
+        return [(self._document(state, row), float(1 - score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        state, rows, _ = self._candidates(embedding, k, filter)
+        return [self._document(state, row) for row in rows]
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, filter=None, **kwargs):
+        state, rows, scores = self._candidates(embedding, fetch_k, filter)
+        if not len(rows):
+            return []
+        vectors = np.asarray(state[3][rows])
+        selected = [0]
+        while len(selected) < min(k, len(rows)):
+            redundancy = (vectors @ vectors[selected].T).max(axis=1)
+            mmr = lambda_mult * scores - (1 - lambda_mult) * redundancy
+            mmr[selected] = -np.inf
+            selected.append(int(np.argmax(mmr)))
+        return [self._document(state, rows[i]) for i in selected]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k=k, filter=filter)
@@ -1,152 +1,367 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, CData, NavigableString
+import importlib.util
+import json
 import requests
 import os
+import re
 from urllib.parse import urljoin
-import time
+import atexit
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import sys
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from tracing import get_logger
+# Selenium chỉ được import khi có trang cần render bằng browser
 
 sys.stdout.reconfigure(encoding='utf-8')
 sys.stderr.reconfigure(encoding='utf-8')
 
 load_dotenv()
 
+logger = get_logger('rag.crawler')
+
+# Số route crawl song song và số browser tối đa được giữ lại để dùng tiếp
+CRAWL_WORKERS = int(os.getenv('CRAWL_WORKERS', '3'))
+CRAWL_BROWSER_POOL_SIZE = int(os.getenv('CRAWL_BROWSER_POOL_SIZE', str(CRAWL_WORKERS)))
+# Thời gian tối đa đợi trang render xong và CSS selector báo trang đã sẵn sàng (nếu có)
+CRAWL_READY_TIMEOUT = float(os.getenv('CRAWL_READY_TIMEOUT', '10'))
+CRAWL_READY_SELECTOR = os.getenv('CRAWL_READY_SELECTOR', '')
+# Thử tải HTML tĩnh bằng requests trước, chỉ dùng browser khi trang cần JavaScript
+CRAWL_STATIC_FIRST = os.getenv('CRAWL_STATIC_FIRST', 'true').lower() == 'true'
+CRAWL_HTTP_TIMEOUT = float(os.getenv('CRAWL_HTTP_TIMEOUT', '5'))
+# HTML tĩnh chỉ được dùng khi có CRAWL_READY_SELECTOR (nếu đặt) hoặc đủ số ký tự nội dung;
+# khung SPA chỉ có chữ "Đang tải..." thì vẫn phải render bằng browser
+CRAWL_STATIC_MIN_CHARS = int(os.getenv('CRAWL_STATIC_MIN_CHARS', '100'))
+
+# Parser HTML: lxml nhanh hơn nhiều nếu đã cài, không có thì dùng html.parser có sẵn
+HTML_PARSER = os.getenv('CRAWL_HTML_PARSER', 'lxml' if importlib.util.find_spec('lxml') else 'html.parser')
+
+BLOCK_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'li', 'div'}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+SKIP_TAGS = {'script', 'style', 'nav', 'footer', 'noscript', 'template'}
+
+class PageReady:
+    # Điều kiện cho WebDriverWait: document đã load xong, selector (nếu có) đã xuất hiện
+    # và nội dung text của body không còn thay đổi giữa hai lần kiểm tra
+    def __init__(self, selector=''):
+        self.selector = selector
+        self.last_length = -1
+
+    def __call__(self, driver):
+        from selenium.webdriver.common.by import By
+        if driver.execute_script("return document.readyState") != "complete":
+            return False
+        if self.selector and not driver.find_elements(By.CSS_SELECTOR, self.selector):
+            return False
+        length = driver.execute_script("return document.body ? document.body.innerText.length : 0")
+        stable = length > 0 and length == self.last_length
+        self.last_length = length
+        return stable
+
+class BrowserPool:
+    # Giữ lại các Chrome headless đã mở để dùng cho những lần crawl sau
+    def __init__(self, arguments, size):
+        self.arguments = list(arguments)
+        self.size = max(1, size)
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+
+    @contextmanager
+    def acquire(self):
+        self.slots.acquire()
+        driver = None
+        try:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                driver = self._open()
+                with self.lock:
+                    self.created += 1
+            yield driver
+        except Exception:
+            # Browser lỗi thì bỏ đi, lần sau mở browser mới
+            if driver is not None:
+                self._quit(driver)
+                driver = None
+            raise
+        finally:
+            if driver is not None:
+                self.idle.put(driver)
+            self.slots.release()
+
+    def _open(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        logger.debug("Đang mở browser mới")
+        options = Options()
+        for argument in self.arguments:
+            options.add_argument(argument)
+        return webdriver.Chrome(options=options)
+
+    def _quit(self, driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error(f"Lỗi khi đóng browser: {str(e)}")
+        with self.lock:
+            self.created -= 1
+
+    def close(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(driver)
+        logger.info("Đã đóng browser")
+
 class WebCrawler:
-    def __init__(self):
-        self.frontend_url = os.getenv('FRONTEND_URL')
+    def __init__(self, frontend_url=None, max_workers=None, pool_size=None):
+        self.frontend_url = frontend_url or os.getenv('FRONTEND_URL')
         if not self.frontend_url:
             raise Exception("Không tìm thấy FRONTEND_URL trong file .env")
+        self.max_workers = max_workers or CRAWL_WORKERS
         
         self.base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
         self.crawled_data_dir = os.path.join(self.base_dir, 'documents', 'crawled_data')
         os.makedirs(self.crawled_data_dir, exist_ok=True)
         
-        self.chrome_options = Options()
-        self.chrome_options.add_argument('--headless')
-        self.chrome_options.add_argument('--no-sandbox')
-        self.chrome_options.add_argument('--disable-dev-shm-usage')
+        self.chrome_arguments = ['--headless', '--no-sandbox', '--disable-dev-shm-usage']
+        self.browser_pool = BrowserPool(self.chrome_arguments, pool_size or CRAWL_BROWSER_POOL_SIZE)
+        self.session = requests.Session()
+        # ETag của lần tải HTML tĩnh trước, dùng để bỏ qua trang không đổi
+        self.etags = {}
 
     def save_content(self, route, content):
         filename = f"{route}.txt"
         filepath = os.path.join(self.crawled_data_dir, filename)
-        print(f"Lưu nội dung vào file: {filepath}", file=sys.stderr)
-        print(f"Số lượng ký tự: {len(content)}", file=sys.stderr)
+        logger.debug(f"Lưu nội dung vào file: {filepath}")
+        logger.debug(f"Số lượng ký tự: {len(content)}")
         
         # Format nội dung trước khi lưu
         formatted_content = content.replace("\n\n\n", "\n").replace("\n\n", "\n")
         
+        # Nội dung không đổi thì giữ nguyên file, tránh index lại
+        if os.path.exists(filepath):
+            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                if f.read() == formatted_content:
+                    logger.info(f"Nội dung {filename} không thay đổi")
+                    return False
+        
         with open(filepath, 'w', encoding='utf-8', errors='ignore') as f:
             f.write(formatted_content)
-        print(f"Đã lưu thành công file {filename}", file=sys.stderr)
+        logger.info(f"Đã lưu thành công file {filename}")
+        return True
 
-    def extract_text_content(self, driver):
-        print("Đang đợi trang load...", file=sys.stderr)
-        time.sleep(2)
-        
-        print("Đang lấy nội dung trang...", file=sys.stderr)
-        page_source = driver.page_source
-        soup = BeautifulSoup(page_source, 'html.parser')
-        
-        print("Đang xử lý nội dung...", file=sys.stderr)
-        for tag in soup(['script', 'style', 'nav', 'footer']):
-            tag.decompose()
-            
-        # Tạo dictionary để lưu nội dung đã xử lý
-        processed_content = {}
-        
-        # Xử lý từng phần riêng biệt
-        def process_plan(plan_name, price, features):
-            if plan_name and price and features:
-                return f"{plan_name}:\n- Giá: {price}\n- Tính năng:\n  + " + "\n  + ".join(features)
-            return None
-            
-        current_plan = None
-        current_price = None
-        current_features = []
+    def save_records(self, route, records):
+        # Bản có cấu trúc của nội dung đã crawl (không được index, chỉ .txt được index)
+        filepath = os.path.join(self.crawled_data_dir, f"{route}.json")
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
+
+    def extract_records(self, page_source):
+        # Duyệt DOM một lần: mỗi text node chỉ được gán cho thẻ khối gần nhất chứa nó
+        # (h1-h6, p, li, div), nên div lồng nhau không bị lấy lại text của con.
+        # Trả về các record có cấu trúc: gói tập {"type": "plan", ...} và các mục
+        # theo tiêu đề {"type": "section", ...} (vd: lớp học, huấn luyện viên)
+        soup = BeautifulSoup(page_source, HTML_PARSER)
         
-        text_elements = []
-        for element in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'li', 'div']):
-            try:
-                text = element.get_text(strip=True)
-                if not text:
-                    continue
-                    
-                # Xử lý các plan
-                if "Plan" in text or "VIP" in text:
-                    if current_plan:
-                        plan_text = process_plan(current_plan, current_price, current_features)
-                        if plan_text:
-                            text_elements.append(plan_text)
-                    current_plan = text
-                    current_price = None
-                    current_features = []
-                elif "₫" in text and current_plan:
-                    current_price = text
-                elif current_plan and len(text) > 10:
-                    if text not in current_features and "Get Started" not in text:
-                        current_features.append(text)
-                        
-            except Exception as e:
-                print(f"Lỗi khi xử lý text: {str(e)}", file=sys.stderr)
+        logger.debug("Đang xử lý nội dung...")
+        blocks = []
+        stack = [(soup, None)]
+        while stack:
+            node, block = stack.pop()
+            if isinstance(node, NavigableString):
+                if type(node) in (NavigableString, CData) and block is not None:
+                    # Giữ nguyên text node: thẻ inline có thể cắt giữa một từ (Gi<b>á</b>)
+                    block["parts"].append(str(node))
                 continue
+            if node.name in SKIP_TAGS:
+                continue
+            if node.name in BLOCK_TAGS:
+                block = {"tag": node.name, "parts": []}
+                blocks.append(block)
+            # Đẩy ngược để lấy ra đúng thứ tự trong tài liệu
+            stack.extend((child, block) for child in reversed(node.contents))
         
-        # Xử lý plan cuối cùng
-        if current_plan:
-            plan_text = process_plan(current_plan, current_price, current_features)
-            if plan_text:
-                text_elements.append(plan_text)
+        records = []
+        current = None
+        seen = set()
+        for block in blocks:
+            text = re.sub(r"\s+", " ", "".join(block["parts"])).strip()
+            if not text:
+                continue
+            
+            # Xử lý các plan
+            if "Plan" in text or "VIP" in text:
+                current = {"type": "plan", "name": text, "price": None, "features": []}
+                records.append(current)
+                seen = set()
+            elif current is not None and current["type"] == "plan":
+                if "₫" in text:
+                    current["price"] = text
+                elif len(text) > 10 and text not in seen and "Get Started" not in text:
+                    seen.add(text)
+                    current["features"].append(text)
+            elif block["tag"] in HEADING_TAGS:
+                current = {"type": "section", "title": text, "items": []}
+                records.append(current)
+                seen = set()
+            elif text not in seen and "Get Started" not in text:
+                if current is None:
+                    current = {"type": "section", "title": None, "items": []}
+                    records.append(current)
+                seen.add(text)
+                current["items"].append(text)
         
-        print(f"Đã tìm thấy {len(text_elements)} đoạn text có ý nghĩa", file=sys.stderr)
+        # Plan phải có đủ tên, giá và tính năng; mục phải có nội dung
+        records = [
+            record for record in records
+            if (record["type"] == "plan" and record["price"] and record["features"])
+            or (record["type"] == "section" and record["items"])
+        ]
+        logger.debug(f"Đã tìm thấy {len(records)} record từ {len(blocks)} khối")
+        return records
+
+    @staticmethod
+    def format_record(record):
+        if record["type"] == "plan":
+            return f"{record['name']}:\n- Giá: {record['price']}\n- Tính năng:\n  + " + "\n  + ".join(record["features"])
+        items = "\n".join(f"- {item}" for item in record["items"])
+        return f"{record['title']}:\n{items}" if record["title"] else items
+
+    def extract_text_content(self, page_source):
+        text_elements = [self.format_record(record) for record in self.extract_records(page_source)]
         if len(text_elements) > 0:
-            print("Ví dụ nội dung:", file=sys.stderr)
-            print(text_elements[0][:200], file=sys.stderr)
-                
+            logger.debug("Ví dụ nội dung:")
+            logger.debug(text_elements[0][:200])
         return text_elements
 
+    def fetch_static(self, url):
+        # Tải HTML tĩnh, trang SPA chưa render sẽ không có nội dung và trả về [].
+        # Trả về None nếu server báo trang không đổi (304) so với lần crawl trước.
+        headers = {}
+        if url in self.etags:
+            headers['If-None-Match'] = self.etags[url]
+        try:
+            response = self.session.get(url, headers=headers, timeout=CRAWL_HTTP_TIMEOUT)
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"Không tải được HTML tĩnh {url}: {str(e)}")
+            return []
+        
+        records = self.extract_records(response.text)
+        if records and not self.static_ready(response.text, records):
+            logger.debug(f"HTML tĩnh {url} chưa có nội dung thật, cần render")
+            return []
+        if records and response.headers.get('ETag'):
+            self.etags[url] = response.headers['ETag']
+        return records
+
+    def static_ready(self, page_source, records):
+        if CRAWL_READY_SELECTOR:
+            return BeautifulSoup(page_source, HTML_PARSER).select_one(CRAWL_READY_SELECTOR) is not None
+        return sum(len(self.format_record(record)) for record in records) >= CRAWL_STATIC_MIN_CHARS
+
+    def fetch_rendered(self, url):
+        # Dùng browser trong pool, đợi trang sẵn sàng thay vì sleep cố định
+        from selenium.webdriver.support.ui import WebDriverWait
+        with self.browser_pool.acquire() as driver:
+            logger.debug(f"Đang truy cập {url}")
+            driver.get(url)
+
+            logger.debug("Đang đợi trang load...")
+            try:
+                WebDriverWait(driver, CRAWL_READY_TIMEOUT, poll_frequency=0.25).until(
+                    PageReady(CRAWL_READY_SELECTOR)
+                )
+            except Exception:
+                logger.warning(f"Hết thời gian đợi {url}, dùng nội dung hiện có")
+
+            logger.debug("Đang lấy nội dung trang...")
+            return self.extract_records(driver.page_source)
+
     def crawl_route(self, route):
+        url = urljoin(self.frontend_url, f"/{route}")
         try:
-            url = urljoin(self.frontend_url, f"/{route}")
-            print(f"=== Bắt đầu crawl {url} ===", file=sys.stderr)
+            logger.info(f"=== Bắt đầu crawl {url} ===")
             
-            driver = webdriver.Chrome(options=self.chrome_options)
-            try:
-                print(f"Đang truy cập {url}", file=sys.stderr)
-                driver.get(url)
+            records = self.fetch_static(url) if CRAWL_STATIC_FIRST else []
+            if records is None:
+                logger.info(f"Trang {route} không thay đổi (ETag)")
+                return True
+            if records:
+                logger.info(f"Dùng HTML tĩnh cho {route}, không cần browser")
+            else:
+                records = self.fetch_rendered(url)
                 
-                content = self.extract_text_content(driver)
+            if records:
+                logger.debug("Đang lọc nội dung trùng lặp...")
+                unique_records = {}
+                for record in records:
+                    unique_records.setdefault(self.format_record(record), record)
+                logger.debug(f"Còn lại {len(unique_records)} record sau khi lọc")
                 
-                if content:
-                    print("Đang lọc nội dung trùng lặp...", file=sys.stderr)
-                    unique_content = list(dict.fromkeys(content))
-                    print(f"Còn lại {len(unique_content)} đoạn text sau khi lọc", file=sys.stderr)
-                    
-                    self.save_content(route, '\n\n'.join(unique_content))
-                    print(f"=== Crawl {route} thành công ===", file=sys.stderr)
-                    return True
-                else:
-                    print(f"Không tìm thấy nội dung trong {route}", file=sys.stderr)
-                    return False
-                    
-            finally:
-                driver.quit()
-                print("Đã đóng browser", file=sys.stderr)
+                self.save_content(route, '\n\n'.join(unique_records))
+                self.save_records(route, list(unique_records.values()))
+                logger.info(f"=== Crawl {route} thành công ===")
+                return True
+            else:
+                logger.warning(f"Không tìm thấy nội dung trong {route}")
+                return False
                 
         except Exception as e:
-            print(f"Lỗi khi crawl {url}: {str(e)}", file=sys.stderr)
+            logger.error(f"Lỗi khi crawl {url}: {str(e)}")
             return False
 
+    def crawl_routes(self, routes):
+        # Crawl nhiều route song song, tối đa max_workers route cùng lúc
+        routes = list(dict.fromkeys(routes))
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(routes) or 1))) as executor:
+            results = executor.map(self.crawl_route, routes)
+            return dict(zip(routes, results))
+
+    def close(self):
+        self.browser_pool.close()
+        self.session.close()
+
+# Crawler dùng chung trong process để giữ lại browser giữa các lần crawl
+_crawler = None
+_crawler_lock = threading.Lock()
+
+def get_crawler():
+    global _crawler
+    with _crawler_lock:
+        if _crawler is None:
+            _crawler = WebCrawler()
+            atexit.register(_crawler.close)
+        return _crawler
+
 def crawl_website(route=None):
     try:
-        crawler = WebCrawler()
+        crawler = get_crawler()
         if route:
             return crawler.crawl_route(route)
         return False
     except Exception as e:
-        print(f"Lỗi: {str(e)}", file=sys.stderr)
+        logger.error(f"Lỗi: {str(e)}")
         return False
 
+def crawl_websites(routes):
+    # Trả về {route: True/False}
+    try:
+        return get_crawler().crawl_routes(routes)
+    except Exception as e:
+        logger.error(f"Lỗi: {str(e)}")
+        return {route: False for route in routes}
+
 if __name__ == "__main__":
-    # Test crawl một route cụ thể
-    crawl_website("instructors") 
\ No newline at end of file
+    # Test crawl các route, vd: python web_crawler.py instructors membership
+    routes = sys.argv[1:] or ["instructors"]
+    print(crawl_websites(routes))
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import threading
+from collections import OrderedDict, deque
+from tracing import MetricsRegistry, get_logger
+
+logger = get_logger('rag.pool')
+
+class RemoteScheduler:
+    # Thay RefreshScheduler trong worker: việc crawl do process cha làm,
+    # worker chỉ gửi yêu cầu lên qua stdout
+    running = True
+
+    def __init__(self, emit):
+        self.emit = emit
+
+    def request(self, route):
+        self.emit({"type": "schedule", "route": route})
+
+class Worker:
+    def __init__(self, index, pid, writer, reader):
+        self.index = index
+        self.pid = pid
+        self.writer = writer
+        self.reader = reader
+        self.inflight = set()
+        self.alive = True
+
+class WorkerPool:
+    # Chế độ pre-fork: process cha đã load model embedding và index rồi mới fork,
+    # các worker dùng chung các trang bộ nhớ đó (copy-on-write). Cha đọc request từ stdin,
+    # chia cho worker đang ít request nhất (cùng conversation_id luôn về cùng worker
+    # vì hội thoại lưu trong worker), mỗi worker tối đa capacity request cùng lúc.
+    # Hết chỗ thì request chờ trong hàng đợi tối đa max_queue, đầy nữa thì trả lỗi ngay.
+    MAX_ASSIGNMENTS = 10000
+
+    def __init__(self, size, worker_main, emit, capacity=32, max_queue=64, fork_lock=None, on_schedule=None):
+        self.size = size
+        self.worker_main = worker_main
+        self.emit = emit
+        self.capacity = max(1, capacity)
+        self.max_queue = max_queue
+        self.fork_lock = fork_lock
+        self.on_schedule = on_schedule
+        self.workers = [None] * size
+        self.queue = deque()
+        self.assignments = OrderedDict()
+        self.metrics_requests = {}
+        self.lock = threading.RLock()
+        self.threads = []
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        from_worker, worker_out = os.pipe()
+        worker_in, to_worker = os.pipe()
+        # Giữ fork_lock lúc fork để worker không nhận bản sao của lock đang bị thread khác giữ
+        if self.fork_lock is not None:
+            self.fork_lock.acquire()
+        try:
+            pid = os.fork()
+        finally:
+            if self.fork_lock is not None:
+                self.fork_lock.release()
+
+        if pid == 0:
+            code = 0
+            try:
+                os.close(from_worker)
+                os.close(to_worker)
+                # Pipe tới các worker khác phải đóng, nếu không chúng không bao giờ thấy EOF
+                for worker in self.workers:
+                    if worker is not None:
+                        for pipe in (worker.writer, worker.reader):
+                            try:
+                                os.close(pipe.fileno())
+                            except (OSError, ValueError):
+                                pass
+                os.dup2(worker_in, 0)
+                os.dup2(worker_out, 1)
+                os.close(worker_in)
+                os.close(worker_out)
+                # Bỏ buffer stdin/stdout thừa hưởng từ process cha
+                sys.stdin = open(0, 'r', encoding='utf-8', closefd=False)
+                sys.stdout = open(1, 'w', encoding='utf-8', closefd=False)
+                self.worker_main(index)
+            except BaseException as e:
+                logger.error(f"Worker {index} dừng vì lỗi: {str(e)}")
+                code = 1
+            finally:
+                os._exit(code)
+
+        os.close(worker_in)
+        os.close(worker_out)
+        worker = Worker(
+            index,
+            pid,
+            writer=os.fdopen(to_worker, 'w', encoding='utf-8'),
+            reader=os.fdopen(from_worker, 'r', encoding='utf-8')
+        )
+        with self.lock:
+            self.workers[index] = worker
+        thread = threading.Thread(target=self._read, args=(worker,), name=f"pool-{index}", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        logger.info(f"Worker {index} chạy với pid {pid}")
+
+    def _send(self, worker, message):
+        try:
+            worker.writer.write(json.dumps(message) + "\n")
+            worker.writer.flush()
+            return True
+        except (OSError, ValueError) as e:
+            logger.error(f"Không gửi được tới worker {worker.index}: {str(e)}")
+            return False
+
+    def broadcast(self, message):
+        with self.lock:
+            for worker in self.workers:
+                if worker is not None and worker.alive:
+                    self._send(worker, message)
+
+    def _pick(self, request):
+        # Worker nhận request, None nếu phải chờ
+        conversation_id = request.get("conversation_id")
+        if conversation_id is not None and conversation_id in self.assignments:
+            self.assignments.move_to_end(conversation_id)
+            worker = self.workers[self.assignments[conversation_id]]
+            if worker is not None and worker.alive:
+                return worker if len(worker.inflight) < self.capacity else None
+        candidates = [
+            worker for worker in self.workers
+            if worker is not None and worker.alive and len(worker.inflight) < self.capacity
+        ]
+        if not candidates:
+            return None
+        worker = min(candidates, key=lambda worker: len(worker.inflight))
+        if conversation_id is not None:
+            self.assignments[conversation_id] = worker.index
+            while len(self.assignments) > self.MAX_ASSIGNMENTS:
+                self.assignments.popitem(last=False)
+        return worker
+
+    def _dispatch(self, worker, request):
+        worker.inflight.add(request.get("id"))
+        if not self._send(worker, request):
+            worker.inflight.discard(request.get("id"))
+            self._fail(request.get("id"), "Worker không phản hồi")
+
+    def _fail(self, request_id, message):
+        self.emit({"id": request_id, "type": "error", "content": f"System Error: {message}"})
+        self.emit({"id": request_id, "type": "done"})
+
+    def _pump(self):
+        # Chuyển các request đang chờ sang worker vừa có chỗ, giữ thứ tự đến
+        for request in list(self.queue):
+            worker = self._pick(request)
+            if worker is not None:
+                self.queue.remove(request)
+                self._dispatch(worker, request)
+
+    def cancel(self, request_id):
+        # Request còn trong hàng đợi thì bỏ luôn, đang chạy thì chuyển lệnh hủy cho worker của nó
+        with self.lock:
+            for request in self.queue:
+                if request.get("id") == request_id:
+                    self.queue.remove(request)
+                    self.emit({"id": request_id, "type": "done"})
+                    return
+            for worker in self.workers:
+                if worker is not None and worker.alive and request_id in worker.inflight:
+                    self._send(worker, {"op": "cancel", "id": request_id})
+                    return
+
+    def submit(self, request):
+        if request.get("op") == "metrics":
+            self._collect_metrics(request.get("id"))
+            return
+        if request.get("op") == "cancel":
+            self.cancel(request.get("id"))
+            return
+        with self.lock:
+            worker = self._pick(request) if not self.queue else None
+            if worker is not None:
+                self._dispatch(worker, request)
+                return
+            if len(self.queue) < self.max_queue:
+                self.queue.append(request)
+                self._pump()
+                return
+        logger.warning(f"Hàng đợi đầy ({self.max_queue}), từ chối request {request.get('id')}")
+        self._fail(request.get("id"), "Server đang quá tải, vui lòng thử lại sau")
+
+    def _collect_metrics(self, request_id):
+        # Số liệu nằm ở từng worker: hỏi tất cả rồi cộng lại
+        with self.lock:
+            workers = [worker for worker in self.workers if worker is not None and worker.alive]
+            if not workers:
+                self.emit({"id": request_id, "type": "metrics", "content": MetricsRegistry().render_prometheus()})
+                self.emit({"id": request_id, "type": "done"})
+                return
+            sent = {f"{request_id}#{worker.index}" for worker in workers}
+            self.metrics_requests[request_id] = {"expected": len(workers), "parts": [], "sent": sent}
+            for worker in workers:
+                self._send(worker, {"id": f"{request_id}#{worker.index}", "op": "metrics_raw"})
+
+    def _metrics_part(self, part_id, content):
+        request_id = part_id.rsplit("#", 1)[0]
+        with self.lock:
+            pending = self.metrics_requests.get(request_id)
+            if pending is None:
+                return
+            pending["parts"].append(content)
+        self._finish_metrics(request_id)
+
+    def _finish_metrics(self, request_id):
+        with self.lock:
+            pending = self.metrics_requests.get(request_id)
+            if pending is None or len(pending["parts"]) < pending["expected"]:
+                return
+            del self.metrics_requests[request_id]
+        merged = MetricsRegistry()
+        for part in pending["parts"]:
+            merged.merge(part)
+        self.emit({"id": request_id, "type": "metrics", "content": merged.render_prometheus()})
+        self.emit({"id": request_id, "type": "done"})
+
+    def _read(self, worker):
+        # Chuyển event của worker ra stdout, trừ các event nội bộ giữa cha và worker
+        for line in worker.reader:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            event_type = event.get("type")
+            if event_type == "ready":
+                continue
+            if event_type == "schedule":
+                if self.on_schedule is not None:
+                    self.on_schedule(event.get("route"))
+                continue
+            if event_type == "metrics_raw":
+                self._metrics_part(event.get("id") or "", event.get("content") or {})
+                continue
+            request_id = event.get("id")
+            if event_type == "done":
+                with self.lock:
+                    if request_id not in worker.inflight:
+                        continue
+                    worker.inflight.discard(request_id)
+                    self.emit(event)
+                    self._pump()
+                continue
+            self.emit(event)
+        self._exited(worker)
+
+    def _exited(self, worker):
+        try:
+            os.waitpid(worker.pid, 0)
+        except ChildProcessError:
+            pass
+        with self.lock:
+            worker.alive = False
+            lost = list(worker.inflight)
+            worker.inflight.clear()
+            # Worker chết thì không còn gửi số liệu của nó
+            waiting = [
+                request_id for request_id, pending in self.metrics_requests.items()
+                if f"{request_id}#{worker.index}" in pending["sent"]
+            ]
+            for request_id in waiting:
+                self.metrics_requests[request_id]["expected"] -= 1
+            respawn = not self.stopping
+        for request_id in lost:
+            self._fail(request_id, "Worker dừng đột ngột")
+        for request_id in waiting:
+            self._finish_metrics(request_id)
+        if respawn:
+            logger.error(f"Worker {worker.index} (pid {worker.pid}) đã dừng, fork worker mới")
+            worker.writer.close()
+            self._spawn(worker.index)
+            with self.lock:
+                self._pump()
+
+    def run(self, lines):
+        # Đọc request (mỗi dòng một JSON) tới khi hết input rồi chờ các worker xử lý xong
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Request không hợp lệ: {str(e)}")
+                continue
+            self.submit(request)
+        self.stop()
+
+    def stop(self):
+        # Các request còn trong hàng đợi vẫn được xử lý, rồi đóng stdin của worker để chúng tự thoát
+        with self.lock:
+            self.stopping = True
+        while True:
+            with self.lock:
+                if not self.queue:
+                    break
+                if not any(worker is not None and worker.alive for worker in self.workers):
+                    lost = list(self.queue)
+                    self.queue.clear()
+                    for request in lost:
+                        self._fail(request.get("id"), "Không còn worker nào chạy")
+                    break
+            threading.Event().wait(0.01)
+        with self.lock:
+            for worker in self.workers:
+                if worker is not None:
+                    worker.writer.close()
+        for thread in list(self.threads):
+            thread.join()